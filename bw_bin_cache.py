@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# on-disk cache of per-bin bigwig summaries (signal sum and covered bases), used by bwcor.py and bw_summary_bed_bins.py
+# also holds the interval reading and prefix sum helpers shared by their vector engines
+# cache layout: <cache_dir>/<bigwig stem>.<key>.<binsize>bp/<chrom>.npz
+#   - key is built from bigwig size, mtime and the checksum of its first and last MiB, plus bin size
+#   - each chromosome is built on first use, written atomically, and evicted by least recent use under a size cap
+# queries take whole bins from the cache and read only the partial bin at each position from the bigwig, so they are exact
+# entry directories are computed once per bigwig in the parent (cache_options), and each process keeps one
+# BinCache per bigwig (get_bin_cache), so the chromosome loaded by one unit is reused by the next units
+
+import os
+import hashlib
+import logging
+
+import numpy as np
+import pyBigWig as pbw
+
+
+logger = logging.getLogger("bigwig bin cache")
+
+## BinCache per (bigwig, binsize, cache_dir) of this process
+_process_caches = {}
+
+
+def log_to(handler:logging.Handler):
+    """show the cache and track naming messages with the handler of the calling script"""
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+def track_names(bws:list, log:logging.Logger=logger) -> list:
+    """bigwig file stems as track names, prefixed by their position when stems collide"""
+    tracks = [os.path.split(bw)[1].split(".")[0] for bw in bws]
+    if len(set(tracks)) != len(tracks):
+        tracks = [f"{i}_{track}" for i, track in enumerate(tracks)]
+        log.warning(f"bigwig names are duplicated, use {tracks} as tracks")
+    return tracks
+
+
+def bigwig_fingerprint(bw:str, probe:int=1<<20) -> str:
+    """checksum of size, mtime and the first/last probe bytes of a bigwig"""
+    st = os.stat(bw)
+    h = hashlib.sha1(f"{st.st_size}|{st.st_mtime_ns}".encode())
+    with open(bw, "rb") as f:
+        h.update(f.read(probe))
+        if st.st_size > probe:
+            f.seek(max(st.st_size-probe, probe))
+            h.update(f.read(probe))
+    return h.hexdigest()
+
+def cache_entry_dir(cache_dir:str, bw:str, binsize:int) -> str:
+    key = hashlib.sha1(f"{bigwig_fingerprint(bw)}|{binsize}".encode()).hexdigest()[:16]
+    stem = os.path.basename(bw).split(".")[0]
+    return os.path.join(cache_dir, f"{stem}.{key}.{binsize}bp")
+
+def read_intervals(bw_hander, chrom:str, end:int, start:int=0, block:int=10_000_000) -> tuple:
+    """read intervals of chrom:start-end in sorted blocks, return (starts, ends, values) arrays"""
+    starts, ends, values = [], [], []
+    for bstart in range(start, end, block):
+        bend = min(bstart+block, end)
+        intervals = bw_hander.intervals(chrom, bstart, bend)
+        if not intervals:
+            continue
+        arr = np.array(intervals, dtype=np.float64)
+        ## intervals crossing block edges are returned twice, so clip them to the block
+        starts.append(np.maximum(arr[:,0].astype(np.int64), bstart))
+        ends.append(np.minimum(arr[:,1].astype(np.int64), bend))
+        values.append(arr[:,2])
+    if len(starts) == 0:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.float64)
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(values)
+
+def cumulative_signal(pos:np.ndarray, starts:np.ndarray, ends:np.ndarray, values:np.ndarray) -> tuple:
+    """signal sum and covered bases in [0, pos) for each pos, from sorted non-overlapping intervals"""
+    if len(starts) == 0:
+        return np.zeros(len(pos)), np.zeros(len(pos))
+    widths = ends - starts
+    csum = np.concatenate([[0.0], np.cumsum(widths*values)])
+    ccov = np.concatenate([[0], np.cumsum(widths)])
+    ## the last interval starting before pos may be only partially covered
+    j = np.searchsorted(starts, pos, side="left") - 1
+    jj = np.maximum(j, 0)
+    part = np.where(j >= 0, np.clip(np.minimum(pos, ends[jj]) - starts[jj], 0, None), 0)
+    sums = np.where(j >= 0, csum[jj] + values[jj]*part, 0.0)
+    covs = np.where(j >= 0, ccov[jj] + part, 0)
+    return sums, covs
+
+def build_chrom_bins(bw_hander, chrom:str, size:int, binsize:int) -> tuple:
+    """per-bin signal sum and covered bases of one chromosome"""
+    starts, ends, values = read_intervals(bw_hander, chrom, size)
+    nbins = (size + binsize - 1)//binsize
+    sums = np.zeros(nbins)
+    covs = np.zeros(nbins, dtype=np.int64)
+    if len(starts) == 0:
+        return sums, covs.astype(np.uint32)
+    ## split intervals at bin edges, then add each piece to its bin
+    first, last = starts//binsize, (ends-1)//binsize
+    pieces = last - first + 1
+    owner = np.repeat(np.arange(len(starts)), pieces)
+    bins = first[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(pieces)-pieces, pieces)
+    width = np.minimum(ends[owner], (bins+1)*binsize) - np.maximum(starts[owner], bins*binsize)
+    np.add.at(sums, bins, width*values[owner])
+    np.add.at(covs, bins, width)
+    return sums, covs.astype(np.uint32)
+
+
+class BinCache:
+    """per-bin summaries of one bigwig, loaded from or written to the cache directory on demand"""
+
+    def __init__(self, bw:str, binsize:int, cache_dir:str, max_bytes:int, entry:str=None):
+        self.bw = bw
+        self.binsize = binsize
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry = entry or cache_entry_dir(cache_dir, bw, binsize)
+        self._cumulative = {}
+
+    def _load(self, chrom:str) -> tuple:
+        if chrom in self._cumulative:
+            return self._cumulative[chrom]
+        path = os.path.join(self.entry, f"{chrom}.npz")
+        if os.path.isfile(path):
+            logger.debug(f"cache hit {path}")
+            with np.load(path) as data:
+                sums, covs, size = data["sum"], data["cov"], int(data["size"])
+            os.utime(path)
+        else:
+            logger.info(f"cache miss {path}, summarize {self.bw} {chrom} into {self.binsize}bp bins")
+            bw_hander = pbw.open(self.bw)
+            size = bw_hander.chroms(chrom)
+            sums, covs = build_chrom_bins(bw_hander, chrom, size, self.binsize)
+            bw_hander.close()
+            os.makedirs(self.entry, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, sum=sums, cov=covs, size=size)
+            os.replace(tmp, path)
+            evict(self.cache_dir, self.max_bytes)
+        csum = np.concatenate([[0.0], np.cumsum(sums)])
+        ccov = np.concatenate([[0.0], np.cumsum(covs, dtype=np.float64)])
+        ## units come chromosome by chromosome, keep only the latest one in memory
+        self._cumulative = {chrom: (csum, ccov, size)}
+        return self._cumulative[chrom]
+
+    def cumulative(self, chrom:str, pos:np.ndarray, bw_hander) -> tuple:
+        """signal sum and covered bases in [0, pos), whole bins from the cache and the partial bin of each pos from bw_hander"""
+        csum, ccov, size = self._load(chrom)
+        pos = np.clip(np.asarray(pos, dtype=np.float64), 0, size)
+        b = (pos//self.binsize).astype(np.int64)
+        sums, covs = csum[b], ccov[b]
+        edge = b*self.binsize
+        partial = pos > edge
+        if partial.any():
+            ## read runs of adjacent partial bins in one go, the intervals are clipped to the runs
+            bins = np.unique(b[partial])
+            runs = np.split(bins, np.flatnonzero(np.diff(bins) > 1) + 1)
+            intervals = [read_intervals(bw_hander, chrom, min((run[-1]+1)*self.binsize, size), run[0]*self.binsize) for run in runs]
+            istarts, iends, ivalues = (np.concatenate(arrs) for arrs in zip(*intervals))
+            p_sum, p_cov = cumulative_signal(pos[partial], istarts, iends, ivalues)
+            e_sum, e_cov = cumulative_signal(edge[partial], istarts, iends, ivalues)
+            sums[partial] += p_sum - e_sum
+            covs[partial] += p_cov - e_cov
+        return sums, covs
+
+
+def cache_options(cache_dir:str, binsize:int, max_bytes:int, bws:list) -> tuple:
+    """(binsize, cache_dir, max_bytes, {bigwig: entry dir}) passed to workers, fingerprints are read once here"""
+    return (binsize, cache_dir, max_bytes, {bw: cache_entry_dir(cache_dir, bw, binsize) for bw in bws})
+
+def get_bin_cache(bw:str, cache_opt:tuple) -> BinCache:
+    """the BinCache of a bigwig kept for the whole process"""
+    binsize, cache_dir, max_bytes, entries = cache_opt
+    key = (bw, binsize, cache_dir)
+    if key not in _process_caches:
+        _process_caches[key] = BinCache(bw, binsize, cache_dir, max_bytes, entry=entries.get(bw))
+    return _process_caches[key]
+
+
+def evict(cache_dir:str, max_bytes:int):
+    """remove least recently used chromosome files until the cache is under max_bytes"""
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith(".npz") and ".tmp." not in name:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+    total = sum(f[1] for f in files)
+    for _, fsize, path in sorted(files):
+        if total <= max_bytes:
+            break
+        logger.info(f"evict cache file {path}")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= fsize
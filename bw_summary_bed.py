@@ -1,44 +1,206 @@
 #!/usr/bin/env python
 
-from logging import warning
+import os
+import sys
+import argparse
+import logging
+import multiprocessing
+
 import numpy as np
-import pyBigWig as pbw
 import pandas as pd
+import pyBigWig as pbw
+
+from bw_bin_cache import read_intervals, cumulative_signal, log_to, track_names
+
+
+# create logger
+logger_name = "bigWigSummary-bed"
+logger = logging.getLogger(logger_name)
+logger.setLevel(logging.DEBUG)
+
+sh=logging.StreamHandler()
+sh.setLevel(logging.DEBUG)
+
+fmt = "%(asctime)-15s %(levelname)s %(name)s : pid - %(process)d :  %(message)s"
+datefmt = "#%a %d %b %Y %H:%M:%S"
+formatter = logging.Formatter(fmt, datefmt)
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+log_to(sh)
+
+STATS=["mean","mean0","max","min","sum","coverage","std"]
+
+
+def generate_opt() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="summary bigwig signal in bed regions, a faster bigWigAverageOverBed for many bigwigs and beds")
+    parser.add_argument("inputs",nargs="*",help="legacy usage: bed bw [oname], written in the old #chr/start/end/name/score/strand layout with score as the mean")
+    parser.add_argument('-b',"--bed",action="append",type=str,dest="beds",default=[],help="bed files, repeat or separate by comma. The first 3 cols are required, name/score/strand are kept if exist\n")
+    parser.add_argument('-w',"--bigwig",action="append",type=str,dest="bws",default=[],help="bigwig files, repeat or separate by comma\n")
+    parser.add_argument('-s',"--stats",action="store",type=str,dest="stats",default=",".join(STATS),help=f"statistics to output, comma separated from {STATS}. mean is over covered bases, mean0 treats uncovered bases as 0, coverage is the covered fraction\n")
+    parser.add_argument('-p',"--processes",action="store",type=int,dest="processes",default=1,help="processes to summarize (bigwig x chromosome) units in parallel\n")
+    parser.add_argument('-o',"--outname",action="store",type=str,dest="outname",default="std",help="output name; .parquet and .feather are written as columnar tables (needs pyarrow), others as tsv\n")
+    return parser
+
+
+def validate_opt(args):
+    flag=True
+    if args.inputs:
+        if len(args.inputs) < 2:
+            logger.error("legacy usage needs: bed bw [oname]")
+            sys.exit(1)
+        args.beds.append(args.inputs[0])
+        args.bws.append(args.inputs[1])
+        if len(args.inputs) > 2:
+            args.outname=args.inputs[2]
+        ## legacy output keeps the old layout, only the mean is needed
+        args.stats="mean"
+    args.beds=",".join(args.beds).split(",") if args.beds else []
+    args.bws=",".join(args.bws).split(",") if args.bws else []
+    if len(args.beds) == 0 or len(args.bws) == 0:
+        logger.error("at least one bed and one bigwig are needed! check -b and -w")
+        flag=False
+    for name in args.beds+args.bws:
+        if not os.path.isfile(name):
+            logger.error(f"input file {name} is not exist! ")
+            flag=False
+    args.stats=[i.strip() for i in args.stats.split(",") if i.strip()]
+    for stat in args.stats:
+        if stat not in STATS:
+            logger.error(f"unknown statistic {stat}, choose from {STATS}")
+            flag=False
+    if args.outname.endswith((".parquet",".feather")):
+        try:
+            import pyarrow
+        except ImportError:
+            logger.error(f"{args.outname} needs pyarrow, install it or output a tsv")
+            flag=False
+    args.tracks=track_names(args.bws,logger)
+    if not flag:
+        sys.exit(1)
+    logger.info(f"input bed files are {args.beds}")
+    logger.info(f"input bigwig files are {args.bws}")
+    return args
+
+
+def load_beds(beds) -> pd.DataFrame:
+    dfs=[]
+    for bed in beds:
+        df=pd.read_csv(bed,sep="\t",comment="#",header=None)
+        if len(df.columns) < 3:
+            logger.error(f"Input bed must contain at least 3 cols! check it ! {bed}")
+            sys.exit(1)
+        df=df.iloc[:,:6]
+        df.columns=["chr","start","end","name","score","strand"][:len(df.columns)]
+        ## carried columns are kept as text, beds may mix '.' and numbers in them and columnar outputs need one type
+        carried=df.columns[3:]
+        df[carried]=df[carried].astype("string")
+        if len(beds) > 1:
+            df.insert(0,"bed",os.path.split(bed)[1].split(".")[0])
+        dfs.append(df)
+        logger.info(f"{len(df)} regions loaded from {bed}")
+    return pd.concat(dfs,ignore_index=True)
+
+
+def summarize_chrom(bw,chrom:str,starts:np.ndarray,ends:np.ndarray,stats:list) -> dict:
+    """all statistics of regions on one chromosome from a single read of its intervals"""
+    out={stat:np.full(len(starts),np.nan) for stat in stats}
+    istarts, iends, ivalues = read_intervals(bw,chrom,ends.max(),starts.min())
+    s_sum, s_cov = cumulative_signal(starts,istarts,iends,ivalues)
+    e_sum, e_cov = cumulative_signal(ends,istarts,iends,ivalues)
+    sums, covs = e_sum-s_sum, e_cov-s_cov
+    lens=ends-starts
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean=np.where(covs > 0,sums/covs,np.nan)
+        if "mean" in stats:
+            out["mean"]=mean
+        if "mean0" in stats:
+            out["mean0"]=sums/lens
+        if "sum" in stats:
+            out["sum"]=sums
+        if "coverage" in stats:
+            out["coverage"]=covs/lens
+        if "std" in stats:
+            ## sample std over covered bases, as bigwig stats do
+            s_sq, _ = cumulative_signal(starts,istarts,iends,ivalues**2)
+            e_sq, _ = cumulative_signal(ends,istarts,iends,ivalues**2)
+            out["std"]=np.where(covs > 1,np.sqrt(np.maximum((e_sq-s_sq-covs*mean**2)/(covs-1),0)),np.nan)
+    if ("max" in stats or "min" in stats) and len(istarts):
+        ## intervals [first, last) overlap each region; reduceat over interleaved bounds gives one value per region
+        first=np.searchsorted(iends,starts,side="right")
+        last=np.searchsorted(istarts,ends,side="left")
+        hit=first < last
+        bounds=np.column_stack([first,last]).ravel()
+        for stat, ufunc in (("max",np.maximum),("min",np.minimum)):
+            if stat in stats:
+                reduced=ufunc.reduceat(np.append(ivalues,np.nan),bounds)[::2]
+                out[stat]=np.where(hit,reduced,np.nan)
+    return out
+
+
+def scan_unit(unit:tuple) -> tuple:
+    """statistics columns of one bed chromosome in one bigwig, regions outside the chromosome stay nan"""
+    bw_path, track, chrom, idx, starts, ends, stats = unit
+    bw=pbw.open(bw_path)
+    chroms=bw.chroms()
+    out={stat:np.full(len(idx),np.nan) for stat in stats}
+    if chrom not in chroms:
+        logger.warning(f"{chrom} is not in {bw_path}, treat its regions as nan")
+    else:
+        valid=(starts < ends) & (ends <= chroms[chrom])
+        if not valid.all():
+            logger.warning(f"{(~valid).sum()} regions at {chrom} are out of range in {bw_path}, treat them as nan")
+        if valid.any():
+            for stat, values in summarize_chrom(bw,chrom,starts[valid],ends[valid],stats).items():
+                out[stat][valid]=values
+    bw.close()
+    return track, idx, out
+
+
+def process(args) -> pd.DataFrame:
+    df_bed=load_beds(args.beds)
+    starts_all=np.maximum(df_bed["start"].to_numpy(dtype=np.int64),0)
+    ends_all=df_bed["end"].to_numpy(dtype=np.int64)
+    chrom_idx=df_bed.groupby("chr",sort=False).indices
+    units=[(bw,track,chrom,idx,starts_all[idx],ends_all[idx],args.stats) for bw,track in zip(args.bws,args.tracks) for chrom,idx in chrom_idx.items()]
+    results={f"{track}.{stat}":np.full(len(df_bed),np.nan) for track in args.tracks for stat in args.stats}
+    logger.info(f"start to summarize {len(units)} (bigwig x chromosome) units with {args.processes} processes")
+    pool=multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    for track, idx, out in (pool.imap_unordered(scan_unit,units) if pool else map(scan_unit,units)):
+        for stat, values in out.items():
+            results[f"{track}.{stat}"][idx]=values
+    if pool:
+        pool.close()
+        pool.join()
+    logger.info("all units are summarized")
+    if args.inputs:
+        return legacy_layout(df_bed,results[f"{args.tracks[0]}.mean"])
+    return pd.concat([df_bed,pd.DataFrame(results)],axis=1)
+
+
+def legacy_layout(df_bed:pd.DataFrame,mean:np.ndarray) -> pd.DataFrame:
+    """the output of `bed bw [oname]` usage: the 6 bed columns under a #chr header, with score replaced by the mean"""
+    df=df_bed.reindex(columns=["chr","start","end","name","score","strand"],fill_value="")
+    df["score"]=mean
+    return df.rename(columns={"chr":"#chr"})
+
+
+def output(df:pd.DataFrame,name):
+    if name=="std":
+        print(df.to_csv(sep="\t",index=False,na_rep="nan"))
+    elif name.endswith(".parquet"):
+        df.to_parquet(name,index=False)
+    elif name.endswith(".feather"):
+        df.to_feather(name)
+    else:
+        df.to_csv(name,sep="\t",index=False,na_rep="nan")
+    return True
 
-import os
-import sys
 
-usage=f"## usage: python {__file__} bed6 bw [oname]"
-
-try:
-    assert len(sys.argv)>3
-except:
-    print(usage)
-    sys.exit(1)
-
-bed=sys.argv[1]
-bigwig=sys.argv[2]
-try:
-    oname=sys.argv[3]
-except:
-    oname="std"
-
-df_bed=pd.read_csv(bed,sep="\t",names=["#chr","start","end","name","score","strand"])
-bw = pbw.open(bigwig)
-
-def get_score(site:pd.Series,bw=bw):
-    try :
-        out=bw.stats(site["#chr"],site["start"],site["end"])[0]
-        if out==None:
-            out=0
-        return out
-    except:
-        return 0
-
-df_bed["score"]=df_bed.apply(get_score,axis=1)
-#df_bed["score"]=df_bed["score"].astype(float)
-if oname=="std":
-    df_bed.to_csv(sep="\t",index=False)
-else:
-    df_bed.to_csv(oname,sep="\t",index=False)
-sys.exit(0)
\ No newline at end of file
+if __name__=='__main__':
+    opt=generate_opt()
+    args=opt.parse_args()
+    logger.info("validating opts input ...")
+    validate_opt(args)
+    df=process(args)
+    output(df,args.outname)
+    logger.info(f"output over! see {args.outname}")
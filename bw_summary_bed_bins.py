@@ -3,6 +3,7 @@ import sys
 import re
 import argparse
 import logging
+import multiprocessing
 
 import pandas as pd
 import numpy as np
@@ -10,6 +11,8 @@ import pyBigWig as pbw
 
 from copy import deepcopy
 
+from bw_bin_cache import read_intervals, cumulative_signal, cache_options, get_bin_cache, log_to, track_names
+
 
 # create logger
 logger_name = "bigWigSummary-bins"
@@ -24,19 +27,30 @@ datefmt = "#%a %d %b %Y %H:%M:%S"
 formatter = logging.Formatter(fmt, datefmt)
 sh.setFormatter(formatter)
 logger.addHandler(sh)
+log_to(sh)
 
 
 def generate_opt() -> argparse.ArgumentParser:
     parser=argparse.ArgumentParser()
-    parser.add_argument('-b',"--bed",action="store",type=str, dest="bed", required=True, help="the bed file your input, must have 6 columns or more, and the 4th col will be used as id in output\n")
-    parser.add_argument('-w',"--bigwig",action="store",type=str, dest="bw", required=True, help="the bigwig file you want to scan\n")
+    parser.add_argument('-b',"--bed",action="store",type=str, dest="bed", required=True, help="the bed (or bigBed) file your input, must have 6 columns or more, and the 4th col will be used as id in output\n")
+    parser.add_argument('-w',"--bigwig",action="append",type=str, dest="bws", required=True, help="the bigwig files you want to scan, repeat or separate by comma; region geometry is computed once for all\n")
     parser.add_argument('-n',"--bins",action="store",type=int,default=1,dest="bins",help="how many data points you want to scan in the each region\n")
-    parser.add_argument("--bylen",action="store_true",default=False,dest="bylen",help="if set, the length of each bin will be same, and equals to the num set by --bins or other. Defalut is false")
+    parser.add_argument("--bylen",action="store_true",default=False,dest="bylen",help="if set, --bins and the tail bins are bin lengths in bp: each part of a region is cut into round(len/binlen) (at least 1) equal bins of len/round(len/binlen) bp with fractional edges, so the region is covered exactly. Runs on the vector engine. Defalut is false")
     parser.add_argument('-5',"--upstream",action="store",type=int,default=0,dest="upstream",help="how many bp to extense the bed region up stream (strand specific, 5' direction)\n ")
     parser.add_argument('-3',"--downstream",action="store",type=int,default=0,dest="downstream",help="how many bp to extense the bed region down stream (strand specific, 3' direction) \n")
     parser.add_argument('--5bins',action="store",type=int,default=100,dest="bins_5",help="how many bins  of 5'direction tail\n")
     parser.add_argument('--3bins',action="store",type=int,default=100,dest="bins_3",help="how many bins  of 3'direction tail\n")
     parser.add_argument('-o','--outname',action="store",type=str,default="std",dest="outname",help="output file name, tsv file. first col is the id in given bed, second is the description of part (upstream, region, and downstream), third is the bin id  in given part, and 4th is the real intensity\n")
+    parser.add_argument('--format',action="store",type=str,default="long",choices=["long","npz","h5","deeptools"],dest="format",help="long: melted tsv (name, site, intensity, label); npz/h5: one row per region with all bins, written per chromosome; deeptools: gzip matrix as computeMatrix scale-regions\n")
+    parser.add_argument('--aggregate',action="store_true",default=False,dest="aggregate",help="only output the metaprofile (n, mean, std and quantiles per track, part and bin) kept as running sums while scanning, instead of the per-region table\n")
+    parser.add_argument('--sketch-size',action="store",type=int,default=10000,dest="sketch_size",help="values kept per bin by reservoir sampling for --aggregate quantiles, 0 to disable\n")
+    parser.add_argument('--quantiles',action="store",type=str,default="0.25,0.5,0.75",dest="quantiles",help="quantiles reported by --aggregate, comma separated\n")
+    parser.add_argument('--sort-regions',action="store",type=str,default=None,dest="sort_regions",help="with --aggregate, also write regions sorted by mean signal over all bins (per track), for heatmaps\n")
+    parser.add_argument('--engine',action="store",type=str,default="stats",choices=["stats","vector"],dest="engine",help="stats: one bw.stats call per region; vector: read each chromosome once for all parts and fill bin matrices by prefix sums\n")
+    parser.add_argument('-p','--processes',action="store",type=int,default=1,dest="processes",help="processes to scan (bigwig x chromosome) units in parallel, runs on the vector engine\n")
+    parser.add_argument('--cache-dir',action="store",type=str,default=None,dest="cache_dir",help="if set, keep per-bin bigwig summaries here and answer bins from them, shared with bwcor.py\n")
+    parser.add_argument('--cache-binsize',action="store",type=int,default=50,dest="cache_binsize",help="bin size of the cache, the partial cached bins at bin edges are read from the bigwig\n")
+    parser.add_argument('--cache-size',action="store",type=float,default=50,dest="cache_size",help="cache size cap in GB, least recently used files are evicted\n")
     parser.add_argument('-0','--non-directional',action="store_false",default=True,dest="directional",help="output the bins in the order of 5->3, or by the order of site, regardless of strand if choose, not recommend!\n")
 
     return parser
@@ -47,8 +61,8 @@ def validate_opt(args:argparse.ArgumentParser):
     if not  os.path.isfile(args.bed):
         logger.error(f"input bed file {args.bed} is not exist! ")
         flag=False
-    elif not os.path.isfile(args.bw):
-        logger.error(f"input bigwig file {args.bw} is not exist! ")
+    elif not all(os.path.isfile(bw) for bw in ",".join(args.bws).split(",")):
+        logger.error(f"input bigwig files {args.bws} are not all exist! ")
         flag=False
     elif args.upstream< args.bins_5 or args.downstream< args.bins_3:
         logger.error("bins num > region length!")
@@ -57,8 +71,52 @@ def validate_opt(args:argparse.ArgumentParser):
         logger.warning(f"turn 5bins to {args.bins_5}")
         logger.warning(f"turn 3bins to {args.bins_3}")
 
+    args.bws=",".join(args.bws).split(",")
+    logger.info(f"input bigwig files are {args.bws}")
+    args.tracks=track_names(args.bws,logger)
+    if (len(args.bws) > 1 or args.processes > 1) and args.engine != "vector":
+        logger.info("several bigwigs or processes run on the vector engine")
+        args.engine="vector"
+
     if args.bylen:
-        logger.info("set by length mode")
+        logger.info("set by length mode, bins are cut with fractional edges and weighted by exact overlap")
+        if args.engine != "vector":
+            logger.info("by length mode runs on the vector engine")
+            args.engine="vector"
+    if args.aggregate:
+        if args.bylen:
+            logger.error("by length mode gives different bin nums per region, --aggregate is not supported")
+            flag=False
+        if args.format != "long":
+            logger.warning("--aggregate writes a metaprofile table, ignore --format")
+            args.format="long"
+        if args.engine != "vector":
+            logger.info("--aggregate runs on the vector engine")
+            args.engine="vector"
+        args.quantiles=[float(q) for q in args.quantiles.split(",") if q.strip()] if args.sketch_size > 0 else []
+    if args.format != "long":
+        if args.outname == "std":
+            logger.error(f"{args.format} output needs a file name, set -o")
+            flag=False
+        if args.bylen:
+            logger.error("by length mode gives different bin nums per region, only long output is supported")
+            flag=False
+        if args.format == "h5":
+            try:
+                import h5py
+            except ImportError:
+                logger.error("h5 output needs h5py, install it or choose another --format")
+                flag=False
+        if args.engine != "vector":
+            logger.info(f"{args.format} output runs on the vector engine")
+            args.engine="vector"
+    if args.cache_dir:
+        args.cache_dir=os.path.abspath(args.cache_dir)
+        os.makedirs(args.cache_dir,exist_ok=True)
+        logger.info(f"use bin cache at {args.cache_dir} with {args.cache_binsize}bp bins")
+        if args.engine != "vector":
+            logger.warning("--cache-dir runs on the vector engine")
+            args.engine="vector"
     
     if not flag:
         sys.exit(1)
@@ -81,6 +139,286 @@ def get_bw_stat(x:pd.Series,bw,nbins=1):
     outs[outs == np.nan ]="nan"    
     return outs
 
+def get_chrom_bins(starts:np.ndarray,ends:np.ndarray,nbins:int,cumulative) -> np.ndarray:
+    """bin means of regions on one chromosome, bins follow bw.stats(nBins=nbins)
+    cumulative(pos) returns signal sum and covered bases in [0, pos)"""
+    edges=starts[:,None]+((ends-starts)[:,None]*np.arange(nbins+1))//nbins
+    sums, covs = cumulative(edges.ravel())
+    sums, covs = np.diff(sums.reshape(edges.shape),axis=1), np.diff(covs.reshape(edges.shape),axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(covs > 0, sums/covs, np.nan)
+
+def get_chrom_scaled_bins(starts:np.ndarray,ends:np.ndarray,binlen:int,minus:np.ndarray,cumulative) -> tuple:
+    """by length bins of regions on one chromosome, each region is cut into round(len/binlen) equal bins with fractional edges
+    return flat (row, site, value) arrays, the overlap of intervals and bins is weighted exactly; site runs 5'->3' on strand"""
+    lens=ends-starts
+    nbins=np.maximum((lens/binlen+0.5).astype(np.int64),1)
+    row=np.repeat(np.arange(len(starts)),nbins+1)
+    local=np.arange(len(row))-np.repeat(np.cumsum(nbins+1)-(nbins+1),nbins+1)
+    edges=starts[row]+lens[row]*local/nbins[row]
+    sums, covs = cumulative(edges)
+    inner=local < nbins[row]
+    sums, covs = np.diff(sums)[inner[:-1]], np.diff(covs)[inner[:-1]]
+    row, local = row[inner], local[inner]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values=np.where(covs > 0, sums/covs, np.nan).astype(np.float32)
+    site=np.where(minus[row],nbins[row]-1-local,local)
+    return row, site, values
+
+def iter_chrom_matrices(parts:list,bw,cache=None,bylen=False):
+    """for each chromosome, yield (chrom, positions, blocks) with one float32 (regions x nbins) block per (df, nbins) part
+    each chromosome is read once for all parts, regions out of range or shorter than 2bp are left as nan
+    in by length mode nbins is the bin length, and each block is a flat (row, site, value) tuple instead"""
+    chroms=bw.chroms()
+    groups=[df_p.groupby("chr",sort=False).indices for df_p,_ in parts]
+    starts_all=[np.maximum(df_p["start"].to_numpy(dtype=np.int64),0) for df_p,_ in parts]
+    ends_all=[df_p["end"].to_numpy(dtype=np.int64) for df_p,_ in parts]
+    longs=[(df_p["start"]+1 < df_p["end"]).to_numpy() for df_p,_ in parts]
+    minuses=[(df_p["strand"]=="-").to_numpy() for df_p,_ in parts]
+    for chrom in dict.fromkeys(c for g in groups for c in g):
+        idxs=[g.get(chrom,np.zeros(0,dtype=np.int64)) for g in groups]
+        if bylen:
+            blocks=[(np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.float32)) for _ in parts]
+        else:
+            blocks=[np.full((len(idx),nbins),np.nan,dtype=np.float32) for idx,(_,nbins) in zip(idxs,parts)]
+        if chrom not in chroms:
+            logger.warning(f"{chrom} is not in bigwig, treat its regions as nan")
+            yield chrom, idxs, blocks
+            continue
+        valids=[(starts_all[k][idx] < ends_all[k][idx]) & (ends_all[k][idx] <= chroms[chrom]) & longs[k][idx] for k,idx in enumerate(idxs)]
+        if sum(valid.sum() for valid in valids) == 0:
+            yield chrom, idxs, blocks
+            continue
+        if cache is not None:
+            cumulative=lambda pos: cache.cumulative(chrom,pos,bw)
+        else:
+            lo=min(starts_all[k][idx][valid].min() for k,(idx,valid) in enumerate(zip(idxs,valids)) if valid.any())
+            hi=max(ends_all[k][idx][valid].max() for k,(idx,valid) in enumerate(zip(idxs,valids)) if valid.any())
+            intervals=read_intervals(bw,chrom,hi,lo)
+            cumulative=lambda pos: cumulative_signal(pos,*intervals)
+        for k,(idx,valid) in enumerate(zip(idxs,valids)):
+            if bylen:
+                if valid.any():
+                    sel=idx[valid]
+                    row, site, values = get_chrom_scaled_bins(starts_all[k][sel],ends_all[k][sel],parts[k][1],minuses[k][sel],cumulative)
+                    blocks[k]=(np.flatnonzero(valid)[row],site,values)
+                continue
+            if valid.any():
+                sel=idx[valid]
+                blocks[k][valid]=get_chrom_bins(starts_all[k][sel],ends_all[k][sel],parts[k][1],cumulative)
+            minus=minuses[k][idx]
+            blocks[k][minus]=blocks[k][minus,::-1]
+        yield chrom, idxs, blocks
+
+def get_parts_matrices(parts:list,bws:list,processes=1,cache_opt=None) -> list:
+    """fill a float32 (regions x nbins) matrix for each bigwig and each (df, nbins) part"""
+    mats=[[np.full((len(df_p),nbins),np.nan,dtype=np.float32) for df_p,nbins in parts] for _ in bws]
+    for chrom, idxs, track_blocks in iter_track_blocks(parts,bws,processes,cache_opt):
+        for track_mats, blocks in zip(mats,track_blocks):
+            for mat, idx, block in zip(track_mats,idxs,blocks):
+                mat[idx]=block
+    return mats
+
+def scan_track_chrom(unit:tuple) -> list:
+    """bin blocks of all parts on one chromosome, from one bigwig or its bin cache"""
+    bw_path, sub_parts, cache_opt, bylen = unit
+    bw=pbw.open(bw_path)
+    cache=get_bin_cache(bw_path,cache_opt) if cache_opt else None
+    for chrom, idxs, blocks in iter_chrom_matrices(sub_parts,bw,cache,bylen):
+        pass
+    bw.close()
+    return blocks
+
+def iter_track_blocks(parts:list,bws:list,processes=1,cache_opt=None,bylen=False):
+    """for each chromosome, yield (chrom, positions, blocks of every bigwig) with (bigwig x chromosome) units over a process pool"""
+    groups=[df_p.groupby("chr",sort=False).indices for df_p,_ in parts]
+    chrom_list=list(dict.fromkeys(c for g in groups for c in g))
+    chrom_idxs={chrom:[g.get(chrom,np.zeros(0,dtype=np.int64)) for g in groups] for chrom in chrom_list}
+    units=((bw,[(df_p.iloc[idx],nbins) for (df_p,nbins),idx in zip(parts,chrom_idxs[chrom])],cache_opt,bylen) for chrom in chrom_list for bw in bws)
+    pool=multiprocessing.Pool(processes) if processes > 1 else None
+    results=pool.imap(scan_track_chrom,units) if pool else map(scan_track_chrom,units)
+    for chrom in chrom_list:
+        yield chrom, chrom_idxs[chrom], [next(results) for _ in bws]
+    if pool:
+        pool.close()
+        pool.join()
+
+class NpzWriter:
+    """wide npz, one (tracks x regions x bins) matrix_<chr> and rows_<chr> member per chromosome written as it finishes"""
+    def __init__(self,name,columns,tracks):
+        import zipfile
+        self.zf=zipfile.ZipFile(name,"w",allowZip64=True)
+        self._add("columns",np.array(columns,dtype=str))
+        self._add("tracks",np.array(tracks,dtype=str))
+
+    def _add(self,key,arr):
+        with self.zf.open(key+".npy","w",force_zip64=True) as f:
+            np.lib.format.write_array(f,arr,allow_pickle=False)
+
+    def write(self,chrom,rows:pd.DataFrame,block:np.ndarray):
+        self._add(f"matrix_{chrom}",block)
+        self._add(f"rows_{chrom}",rows[["chr","start","end","name","strand"]].astype(str).to_numpy(dtype=str))
+
+    def close(self):
+        self.zf.close()
+
+class H5Writer:
+    """wide HDF5 with a resizable (tracks x regions x bins) matrix and chr/start/end/name/strand datasets, appended per chromosome"""
+    def __init__(self,name,columns,tracks):
+        import h5py
+        self.f=h5py.File(name,"w")
+        ncol=len(columns)
+        self.f.create_dataset("columns",data=np.array(columns,dtype="S"))
+        self.f.create_dataset("tracks",data=np.array(tracks,dtype="S"))
+        self.f.create_dataset("matrix",shape=(len(tracks),0,ncol),maxshape=(len(tracks),None,ncol),dtype="f4",chunks=(1,1024,max(ncol,1)),compression="gzip")
+        self.string_cols=["chr","name","strand"]
+        for col in self.string_cols:
+            self.f.create_dataset(col,shape=(0,),maxshape=(None,),dtype=h5py.string_dtype(),chunks=(1024,))
+        for col in ["start","end"]:
+            self.f.create_dataset(col,shape=(0,),maxshape=(None,),dtype="i8",chunks=(1024,))
+
+    def write(self,chrom,rows:pd.DataFrame,block:np.ndarray):
+        n=self.f["matrix"].shape[1]
+        self.f["matrix"].resize(n+len(rows),axis=1)
+        for key in self.string_cols+["start","end"]:
+            self.f[key].resize(n+len(rows),axis=0)
+        self.f["matrix"][:,n:]=block
+        for col in self.string_cols:
+            self.f[col][n:]=rows[col].astype(str).to_numpy(dtype=object)
+        for col in ["start","end"]:
+            self.f[col][n:]=rows[col].to_numpy(dtype=np.int64)
+
+    def close(self):
+        self.f.close()
+
+class DeeptoolsWriter:
+    """gzip matrix in the deepTools computeMatrix scale-regions layout, tracks side by side as samples, rows appended per chromosome"""
+    def __init__(self,name,columns,tracks,header:dict):
+        import gzip
+        import json
+        self.fo=gzip.open(name,"wt")
+        self.fo.write("@"+json.dumps(header)+"\n")
+
+    def write(self,chrom,rows:pd.DataFrame,block:np.ndarray):
+        df=rows[["chr","start","end","name","score","strand"]].reset_index(drop=True)
+        df=pd.concat([df,pd.DataFrame(np.hstack(list(block)))],axis=1)
+        df.to_csv(self.fo,sep="\t",header=False,index=False,na_rep="nan")
+
+    def close(self):
+        self.fo.close()
+
+def deeptools_header(args,n_regions,ncol) -> dict:
+    binsize=args.upstream//args.bins_5 if args.bins_5 else (args.downstream//args.bins_3 if args.bins_3 else 1)
+    if args.bins_3 and args.downstream//args.bins_3 != binsize:
+        logger.warning("5' and 3' bin sizes differ, deepTools header uses the 5' one")
+    return {"upstream":[args.upstream if args.bins_5 else 0],"downstream":[args.downstream if args.bins_3 else 0],
+            "body":[args.bins*binsize],"bin size":[binsize],"ref point":[None],"verbose":False,
+            "bin avg type":"mean","missing data as zero":False,"min threshold":None,"max threshold":None,
+            "scale":[1],"skip zeros":False,"nan after end":False,"proc number":1,"sort regions":"keep",
+            "sort using":"mean","unscaled 5 prime":[0],"unscaled 3 prime":[0],
+            "group_labels":[os.path.split(args.bed)[1].split(".")[0]],"group_boundaries":[0,n_regions],
+            "sample_labels":args.tracks,"sample_boundaries":[ncol*i for i in range(len(args.tracks)+1)]}
+
+def output_wide(df_bed,parts,args,cache_opt=None):
+    """write one row per region with the bins of all parts side by side, chromosome by chromosome"""
+    columns=[f"{label}:{i}" for _,nbin,label in parts for i in range(nbin)]
+    if args.format == "npz":
+        writer=NpzWriter(args.outname,columns,args.tracks)
+    elif args.format == "h5":
+        writer=H5Writer(args.outname,columns,args.tracks)
+    else:
+        writer=DeeptoolsWriter(args.outname,columns,args.tracks,deeptools_header(args,len(df_bed),len(columns)))
+    for chrom, idxs, track_blocks in iter_track_blocks([(df,nbin) for df,nbin,_ in parts],args.bws,args.processes,cache_opt):
+        writer.write(chrom,df_bed.iloc[idxs[0]],np.stack([np.hstack(blocks) for blocks in track_blocks]))
+        logger.info(f"{chrom} is written")
+    writer.close()
+    return True
+
+class ProfileAggregator:
+    """running per-bin n, sum and sum of squares of one (track, part), with an optional reservoir sample per bin for quantiles"""
+    def __init__(self,nbins,sketch_size=0,seed=0):
+        self.n=np.zeros(nbins,dtype=np.int64)
+        self.sum=np.zeros(nbins)
+        self.sumsq=np.zeros(nbins)
+        self.sketch_size=sketch_size
+        self.reservoir=np.full((nbins,sketch_size),np.nan,dtype=np.float32)
+        self.rng=np.random.default_rng(seed)
+
+    def add(self,block:np.ndarray):
+        ok=~np.isnan(block)
+        values=np.where(ok,block,0).astype(np.float64)
+        seen=self.n.copy()
+        self.n+=ok.sum(axis=0)
+        self.sum+=values.sum(axis=0)
+        self.sumsq+=(values**2).sum(axis=0)
+        if self.sketch_size == 0:
+            return
+        for j in range(block.shape[1]):
+            col=block[ok[:,j],j]
+            ## algorithm R in batch: item t is kept at a random slot below t+1 if that slot is inside the reservoir
+            t=seen[j]+np.arange(len(col))
+            slot=np.where(t < self.sketch_size,t,self.rng.integers(0,t+1))
+            keep=slot < self.sketch_size
+            self.reservoir[j,slot[keep]]=col[keep]
+
+    def summary(self,quantiles:list) -> pd.DataFrame:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean=self.sum/self.n
+            std=np.sqrt(np.maximum((self.sumsq-self.n*mean**2)/(self.n-1),0))
+        df=pd.DataFrame({"site":np.arange(len(self.n)),"n":self.n,"mean":mean,"std":std})
+        for q in quantiles:
+            with np.errstate(invalid="ignore"):
+                df[f"q{q:g}"]=[np.nanquantile(r,q) if np.isfinite(r).any() else np.nan for r in self.reservoir]
+        return df
+
+def aggregate_profiles(df_bed,parts,args,cache_opt=None) -> pd.DataFrame:
+    """metaprofile per track and part from running sums, the per-region matrix is never kept"""
+    aggs=[[ProfileAggregator(nbin,args.sketch_size,seed=i) for _,nbin,_ in parts] for i in range(len(args.bws))]
+    scores=np.full((len(args.bws),len(df_bed)),np.nan) if args.sort_regions else None
+    for chrom, idxs, track_blocks in iter_track_blocks([(df,nbin) for df,nbin,_ in parts],args.bws,args.processes,cache_opt):
+        for t,blocks in enumerate(track_blocks):
+            for agg,block in zip(aggs[t],blocks):
+                agg.add(block)
+            if scores is not None:
+                values=np.hstack(blocks)
+                counts=(~np.isnan(values)).sum(axis=1)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    scores[t,idxs[0]]=np.where(counts > 0,np.nansum(values,axis=1)/counts,np.nan)
+        logger.info(f"{chrom} is aggregated")
+    results=[]
+    for track,track_aggs in zip(args.tracks,aggs):
+        for agg,(_,_,label) in zip(track_aggs,parts):
+            df=agg.summary(args.quantiles)
+            df.insert(0,"label",label)
+            df.insert(0,"track",track)
+            results.append(df)
+    if scores is not None:
+        dfs=[]
+        for track,score in zip(args.tracks,scores):
+            df=df_bed[["chr","start","end","name","strand"]].copy()
+            df.insert(0,"track",track)
+            df["score"]=score
+            dfs.append(df.sort_values("score",ascending=False,na_position="last"))
+        pd.concat(dfs).to_csv(args.sort_regions,sep="\t",index=False,na_rep="nan")
+        logger.info(f"sorted regions are written to {args.sort_regions}")
+    return pd.concat(results)
+
+def get_parts_scaled(parts:list,bws:list,processes=1,cache_opt=None) -> list:
+    """by length bins of each bigwig and each (df, binlen) part, as long tables of (row, site, intensity)"""
+    results=[[[] for _ in parts] for _ in bws]
+    for chrom, idxs, track_blocks in iter_track_blocks(parts,bws,processes,cache_opt,bylen=True):
+        for track_results, blocks in zip(results,track_blocks):
+            for part_results, idx, (row, site, values) in zip(track_results,idxs,blocks):
+                part_results.append(pd.DataFrame({"row":idx[row],"site":site,"intensity":values}))
+    return [[pd.concat(part_results,ignore_index=True) for part_results in track_results] for track_results in results]
+
+def matrix_to_long(df_p:pd.DataFrame,mat:np.ndarray,label:str) -> pd.DataFrame:
+    df_result=pd.DataFrame(mat,index=df_p["name"])
+    df_result=df_result.reset_index().rename({"index":"name"},axis=1)
+    df_result=df_result.melt(id_vars="name",var_name="site",value_name="intensity").dropna()
+    df_result["label"]=label
+    return df_result
+
 def process_each_part(df,bw,nbins,label,bylen=False):
     df_p=df.query("start+1 < end").dropna()
     if not bylen:
@@ -103,13 +441,17 @@ def process_each_part(df,bw,nbins,label,bylen=False):
     return df_result
 
 def split_df_bed(df_bed,upstream,downstream):
+    plus=(df_bed["strand"]=="+").to_numpy()
+    starts=df_bed["start"].to_numpy()
+    ends=df_bed["end"].to_numpy()
+
     df_upper=deepcopy(df_bed)
-    df_upper["start"]=df_bed.apply(lambda x: x["start"]-upstream if x["strand"]=="+" else x["end"],axis=1)
-    df_upper["end"]=df_bed.apply(lambda x: x["start"] if x["strand"]=="+" else x["end"]+upstream,axis=1)
+    df_upper["start"]=np.where(plus,starts-upstream,ends)
+    df_upper["end"]=np.where(plus,starts,ends+upstream)
 
     df_down=deepcopy(df_bed)
-    df_down["start"]=df_bed.apply(lambda x: x["end"] if x["strand"]=="+" else x["start"]-downstream,axis=1)
-    df_down["end"]=df_bed.apply(lambda x: x["end"]+downstream if x["strand"]=="+" else x["start"],axis=1)
+    df_down["start"]=np.where(plus,ends,starts-downstream)
+    df_down["end"]=np.where(plus,ends+downstream,starts)
 
     return df_upper,df_bed,df_down
 
@@ -120,11 +462,38 @@ def output(df:pd.DataFrame,name):
         df.to_csv(name,sep="\t",index=False)
     return True
 
+def is_bigbed(name) -> bool:
+    with open(name,"rb") as f:
+        return f.read(4) == b"\xeb\xf2\x89\x87"
+
+def read_bigbed(name) -> pd.DataFrame:
+    """load the entries of a bigBed as a bed table, the extra fields are split by tab"""
+    bb=pbw.open(name)
+    dfs=[]
+    for chrom, size in bb.chroms().items():
+        entries=bb.entries(chrom,0,size) or []
+        if len(entries) == 0:
+            continue
+        df=pd.DataFrame(entries,columns=["start","end","rest"])
+        df.insert(0,"chr",chrom)
+        dfs.append(pd.concat([df[["chr","start","end"]],df["rest"].str.split("\t",expand=True)],axis=1))
+    bb.close()
+    df_bed=pd.concat(dfs,ignore_index=True)
+    df_bed.columns=range(len(df_bed.columns))
+    return df_bed
+
 def process(args):
     try:
-        df_bed= pd.read_csv(args.bed,sep="\t",comment="#",usecols=range(0,6),header=None)
+        if is_bigbed(args.bed):
+            logger.info(f"{args.bed} is a bigBed file")
+            df_bed=read_bigbed(args.bed)
+            if len(df_bed.columns) < 6:
+                raise ValueError("incomplete bigBed")
+            df_bed=df_bed.iloc[:,:6]
+        else:
+            df_bed= pd.read_csv(args.bed,sep="\t",comment="#",usecols=range(0,6),header=None)
     except:
-        df_bed= pd.read_csv(args.bed,sep="\t",comment="#",header=None)
+        df_bed= read_bigbed(args.bed) if is_bigbed(args.bed) else pd.read_csv(args.bed,sep="\t",comment="#",header=None)
         logger.warning(f"input bed has ONLY {len(df_bed.columns)} cols, incomplete!")
         if len(df_bed.columns)<3:
             logger.error(f"Input bed must contain at least 3 cols! check it ! {args.bed}")
@@ -150,23 +519,59 @@ def process(args):
     logger.info("region bed file is loaded  ...")
     assert isinstance(df_bed,pd.DataFrame)
     df_bed.columns=["chr","start","end","name","score","strand"]
-    bw=pbw.open(args.bw)
+    cache_opt=cache_options(args.cache_dir,args.cache_binsize,int(args.cache_size*1024**3),args.bws) if args.cache_dir else None
 
     labels=["0","1","2"]
     results=[]
     bins=[args.bins_5,args.bins,args.bins_3]
     logger.info("start to split and process each regions ...")
-    for df, label, nbin in zip(split_df_bed(df_bed,args.upstream,args.downstream),labels,(args.bins_5,args.bins,args.bins_3)):
-        if nbin==0:
-            logger.warning(f"skip label {label} becaus bins num is 0")
-            continue
-        logger.info(f"start to process label {label} part")
-        new_df=process_each_part(df,bw,nbin,label,bylen=args.bylen)
-        results.append(new_df)
-        new_df==None
-        logger.info(f"label {label} part is processed!")
+    if args.aggregate:
+        parts=[(df,nbin,label) for df, label, nbin in zip(split_df_bed(df_bed,args.upstream,args.downstream),labels,bins) if nbin > 0]
+        df_result=aggregate_profiles(df_bed,parts,args,cache_opt)
+        output(df_result,args.outname)
+        logger.info("output over! see you ~")
+        return df_result
+    elif args.format != "long":
+        parts=[(df,nbin,label) for df, label, nbin in zip(split_df_bed(df_bed,args.upstream,args.downstream),labels,bins) if nbin > 0]
+        output_wide(df_bed,parts,args,cache_opt)
+        logger.info(f"output over! see {args.outname}")
+        return None
+    elif args.engine == "vector":
+        parts=[(df.query("start+1 < end").dropna(),nbin,label) for df, label, nbin in zip(split_df_bed(df_bed,args.upstream,args.downstream),labels,bins) if nbin > 0]
+        if args.bylen:
+            mats=get_parts_scaled([(df_p,nbin) for df_p,nbin,_ in parts],args.bws,args.processes,cache_opt)
+        else:
+            mats=get_parts_matrices([(df_p,nbin) for df_p,nbin,_ in parts],args.bws,args.processes,cache_opt)
+        for track, track_mats in zip(args.tracks,mats):
+            for (df_p,nbin,label),mat in zip(parts,track_mats):
+                if args.bylen:
+                    new_df=pd.DataFrame({"name":df_p["name"].to_numpy()[mat["row"].to_numpy()],"site":mat["site"],"intensity":mat["intensity"]}).dropna()
+                    new_df["label"]=label
+                else:
+                    new_df=matrix_to_long(df_p,mat,label)
+                if len(args.bws) > 1:
+                    new_df["track"]=track
+                results.append(new_df)
+        logger.info("all parts are processed!")
+    else:
+        dfs=split_df_bed(df_bed,args.upstream,args.downstream)
+        for bw_path, track in zip(args.bws,args.tracks):
+            bw=pbw.open(bw_path)
+            for df, label, nbin in zip(dfs,labels,(args.bins_5,args.bins,args.bins_3)):
+                if nbin==0:
+                    logger.warning(f"skip label {label} becaus bins num is 0")
+                    continue
+                logger.info(f"start to process label {label} part of {track}")
+                new_df=process_each_part(df,bw,nbin,label,bylen=args.bylen)
+                if len(args.bws) > 1:
+                    new_df["track"]=track
+                results.append(new_df)
+                new_df==None
+                logger.info(f"label {label} part is processed!")
+            bw.close()
 
-    df_result=pd.concat(results).fillna(value="nan").sort_values(["name","label","site"])
+    sort_cols=["track","name","label","site"] if len(args.bws) > 1 else ["name","label","site"]
+    df_result=pd.concat(results).fillna(value="nan").sort_values(sort_cols)
     logger.info("prepare to output")
     output(df_result,args.outname)
     logger.info("output over! see you ~")
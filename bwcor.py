@@ -10,7 +10,9 @@ import scipy
 import pandas as pd
 import seaborn as sns
 import numpy as np
-from copy import deepcopy
+import multiprocessing
+
+from bw_bin_cache import read_intervals, cumulative_signal, cache_options, get_bin_cache, log_to
 
 # create logger
 logger_name = "bwcor (bigwig correlation caculation)"
@@ -25,11 +27,12 @@ datefmt = "#%a %d %b %Y %H:%M:%S"
 formatter = logging.Formatter(fmt, datefmt)
 sh.setFormatter(formatter)
 logger.addHandler(sh)
+log_to(sh)
 
 def generate_opt() -> argparse.ArgumentParser:
     opt=argparse.ArgumentParser()
 
-    opt.add_argument("-b","--bed",action="append",dest="beds",default=[],required=True)
+    opt.add_argument("-b","--bed",action="append",dest="beds",default=[])
     opt.add_argument("-w","--bigwig",action="append",dest="bws",required=True)
 
     opt.add_argument("-p","--project",action="append",dest="projects",default=[])
@@ -38,13 +41,22 @@ def generate_opt() -> argparse.ArgumentParser:
     opt.add_argument("-o","--outname",action="store",type=str,dest="oname",default="std")
     opt.add_argument("--outstat",action="store",type=str,dest="osname",default=None, help="if you want to out put bw summary matrix, set this")
     opt.add_argument("-d","--ofs",action="store",type=str,dest="ofs",default="\t")
+    opt.add_argument("--engine",action="store",type=str,dest="engine",default="stats",choices=["stats","vector"], help="stats: one bw.stats call per region; vector: read each chromosome once and summarize all regions by prefix sums")
+    opt.add_argument("--chunk-size",action="store",type=int,dest="chunk_size",default=0, help="if set, stream the regions in float32 chunks of this size and accumulate pearson statistics, the full matrix is never kept in memory")
+    opt.add_argument("--bins",action="store",type=int,dest="bins",default=0, help="if set, tile the genome from the bigwig header into bins of this size instead of using beds")
+    opt.add_argument("-m","--method",action="store",type=str,dest="method",default="pearson",choices=["pearson","spearman"])
+    opt.add_argument("--log1p",action="store_true",dest="log1p",default=False, help="correlate log1p transformed signal")
+    opt.add_argument("--cache-dir",action="store",type=str,dest="cache_dir",default=None, help="if set, keep per-bin bigwig summaries here and answer regions from them, runs on the vector engine")
+    opt.add_argument("--cache-binsize",action="store",type=int,dest="cache_binsize",default=50, help="bin size of the cache, the partial bins at region edges are read from the bigwig")
+    opt.add_argument("--cache-size",action="store",type=float,dest="cache_size",default=50, help="cache size cap in GB, least recently used files are evicted")
+    opt.add_argument("-t","--threads","--processes",action="store",type=int,dest="threads",default=1, help="processes to scan (bigwig x chromosome) units in parallel")
 
     return opt
 
 
 def validate_arg(arg) -> tuple :
     logger.info("start to validate input args")
-    beds=",".join(arg.beds).split(",")
+    beds=",".join(arg.beds).split(",") if arg.beds else []
     bws=",".join(arg.bws).split(",")
     projects=",".join(arg.projects).split(",")
 
@@ -54,7 +66,27 @@ def validate_arg(arg) -> tuple :
 
 
 
-    if len(beds) != len(bws):
+    if len(beds) == 0 and arg.bins <= 0:
+        logger.error("neither bed files nor --bins is provided!")
+        sys.exit(1)
+    if arg.bins > 0:
+        if len(beds) > 0:
+            logger.warning(f"--bins {arg.bins} is set, ignore bed files")
+        if arg.engine != "vector":
+            logger.warning("--bins runs on the vector engine")
+            arg.engine="vector"
+    if arg.cache_dir:
+        arg.cache_dir=os.path.abspath(arg.cache_dir)
+        os.makedirs(arg.cache_dir,exist_ok=True)
+        logger.info(f"use bin cache at {arg.cache_dir} with {arg.cache_binsize}bp bins")
+        if arg.engine != "vector":
+            logger.warning("--cache-dir runs on the vector engine")
+            arg.engine="vector"
+    if arg.method == "spearman" and arg.chunk_size > 0:
+        logger.error("spearman needs global ranks and can not be streamed, unset --chunk-size")
+        sys.exit(1)
+
+    if len(beds) > 0 and len(beds) != len(bws):
         logger.error(f"beds and bigwigs are different at length! check -b and -w")
         beds=beds
         #sys.exit(1)
@@ -116,7 +148,156 @@ def get_bw_stat(x:pd.Series,bw) -> float:
         outs=np.nan
     return outs
 
-def process(beds,bws,projects,*args) -> pd.DataFrame:
+def get_bw_region_means(bw, regions:pd.DataFrame, cache=None) -> np.ndarray:
+    """mean signal over covered bases of each region, the same value as bw.stats(chr, start, end)
+    if a BinCache is given, regions are answered from its cached bins instead of the intervals"""
+    out = np.full(len(regions), np.nan)
+    chroms = bw.chroms()
+    starts_all = np.maximum(regions["start"].to_numpy(dtype=np.int64), 0)
+    ends_all = regions["end"].to_numpy(dtype=np.int64)
+    for chrom, idx in regions.groupby("chr", sort=False).indices.items():
+        if chrom not in chroms:
+            logger.warning(f"{chrom} is not in bigwig, treat its regions as nan")
+            continue
+        starts, ends = starts_all[idx], ends_all[idx]
+        valid = (starts < ends) & (ends <= chroms[chrom])
+        if not valid.all():
+            logger.warning(f"{(~valid).sum()} regions at {chrom} are out of range, treat them as nan")
+        if not valid.any():
+            continue
+        if cache is not None:
+            s_sum, s_cov = cache.cumulative(chrom, starts, bw)
+            e_sum, e_cov = cache.cumulative(chrom, ends, bw)
+        else:
+            istarts, iends, ivalues = read_intervals(bw, chrom, ends[valid].max(), starts[valid].min())
+            s_sum, s_cov = cumulative_signal(starts, istarts, iends, ivalues)
+            e_sum, e_cov = cumulative_signal(ends, istarts, iends, ivalues)
+        cov = e_cov - s_cov
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(cov > 0, (e_sum - s_sum)/cov, np.nan)
+        out[idx] = np.where(valid, means, np.nan)
+    return out
+
+def merge_regions(regions:pd.DataFrame) -> pd.DataFrame:
+    """sort and merge overlapping regions in memory, the same as `sort -k1,1 -k2,2n | bedtools merge -d -1`"""
+    codes, chroms = pd.factorize(regions["chr"].astype(str))
+    rank = np.empty(len(chroms), dtype=np.int64)
+    rank[np.argsort(np.asarray(chroms, dtype=str))] = np.arange(len(chroms))
+    codes = rank[codes]
+    chroms = np.sort(np.asarray(chroms, dtype=str))
+    starts = regions["start"].to_numpy(dtype=np.int64)
+    ends = regions["end"].to_numpy(dtype=np.int64)
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+
+    ## move each chromosome to its own coordinate range, so one running max covers all chromosomes
+    low = min(starts.min(), 0)
+    span = max(starts.max(), ends.max()) - low + 1
+    shift = codes*span - low
+    run_end = np.maximum.accumulate(ends + shift)
+    ## -d -1: only regions sharing at least 1bp are merged, book-ended ones are kept apart
+    first = np.flatnonzero(np.concatenate([[True], starts[1:] + shift[1:] >= run_end[:-1]]))
+    last = np.concatenate([first[1:], [len(starts)]]) - 1
+    return pd.DataFrame({"chr":chroms[codes[first]], "start":starts[first], "end":run_end[last] - shift[last]})
+
+def scan_unit(unit:tuple) -> tuple:
+    """means of one chromosome's merged regions in one bigwig, the per-track unit of process()"""
+    bw, project, engine, idx, sub_regions, cache_opt = unit
+    bw_hander=pbw.open(bw)
+    if engine == "vector":
+        cache=get_bin_cache(bw,cache_opt) if cache_opt else None
+        values=get_bw_region_means(bw_hander,sub_regions,cache)
+    else:
+        values=sub_regions.apply(lambda x: get_bw_stat(x,bw_hander), axis=1).to_numpy(dtype=float)
+    bw_hander.close()
+    return project, idx, values
+
+def init_corr_stats(k:int) -> dict:
+    """pearson sufficient statistics: n, shifted sums and cross-products (sums of squares on the diagonal)"""
+    return {"n":0, "shift":None, "sum":np.zeros(k), "cross":np.zeros((k,k))}
+
+def update_corr_stats(stats:dict, block:np.ndarray) -> dict:
+    """add the complete rows of a (regions x tracks) block to the statistics"""
+    block=block[~np.isnan(block).any(axis=1)]
+    if len(block) == 0:
+        return stats
+    if stats["shift"] is None:
+        ## shift by the first means to avoid cancellation in cross - sum*sum/n
+        stats["shift"]=block.mean(axis=0,dtype=np.float64)
+    x=block.astype(np.float64)-stats["shift"]
+    stats["n"]+=len(x)
+    stats["sum"]+=x.sum(axis=0)
+    stats["cross"]+=x.T @ x
+    return stats
+
+def corr_from_stats(stats:dict, names:list) -> pd.DataFrame:
+    n=stats["n"]
+    if n < 2:
+        logger.warning(f"only {n} regions without na, correlation is not available")
+        return pd.DataFrame(np.nan,index=names,columns=names)
+    cov=stats["cross"]-np.outer(stats["sum"],stats["sum"])/n
+    sd=np.sqrt(np.diag(cov))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cor=cov/np.outer(sd,sd)
+    np.fill_diagonal(cor,np.where(sd > 0,1.0,np.nan))
+    return pd.DataFrame(np.clip(cor,-1,1),index=names,columns=names)
+
+def rank_columns(x:np.ndarray) -> np.ndarray:
+    """rank each column, ties get their average rank"""
+    ranks=np.empty(x.shape,dtype=np.float64)
+    for j in range(x.shape[1]):
+        order=np.argsort(x[:,j],kind="mergesort")
+        col=x[order,j]
+        first=np.flatnonzero(np.concatenate([[True],col[1:]!=col[:-1]]))
+        counts=np.diff(np.append(first,len(col)))
+        ranks[order,j]=np.repeat(first+(counts+1)/2,counts)
+    return ranks
+
+def transform_block(block:np.ndarray, log1p=False) -> np.ndarray:
+    if log1p:
+        if (block < -1).any():
+            logger.warning("signal below -1 turns to nan in log1p")
+        with np.errstate(invalid="ignore"):
+            block=np.log1p(block)
+    return block
+
+def tile_genome(chroms:dict, binsize:int) -> pd.DataFrame:
+    """tile chromosomes into fixed size bins, the last bin of each chromosome is truncated"""
+    dfs=[]
+    for chrom, size in chroms.items():
+        starts=np.arange(0,size,binsize,dtype=np.int64)
+        dfs.append(pd.DataFrame({"chr":chrom,"start":starts,"end":np.minimum(starts+binsize,size)}))
+    return pd.concat(dfs,ignore_index=True)
+
+def iter_bin_chunks(chroms:dict, binsize:int, chunk_size:int):
+    """tile the genome lazily, yield (positions, regions) chunks inside each chromosome"""
+    offset=0
+    for chrom, size in chroms.items():
+        for cstart in range(0,size,binsize*chunk_size):
+            starts=np.arange(cstart,min(cstart+binsize*chunk_size,size),binsize,dtype=np.int64)
+            idx=np.arange(offset,offset+len(starts))
+            offset+=len(starts)
+            yield idx, pd.DataFrame({"chr":chrom,"start":starts,"end":np.minimum(starts+binsize,size)},index=idx)
+
+def iter_chunks(regions:pd.DataFrame, chunk_size:int):
+    """split the merged regions into chunks inside each chromosome, yield (positions, regions)"""
+    for idx in regions.groupby("chr",sort=False).indices.values():
+        for i in range(0,len(idx),chunk_size):
+            sub_idx=idx[i:i+chunk_size]
+            yield sub_idx, regions.iloc[sub_idx]
+
+def scan_chunk(unit:tuple) -> tuple:
+    """summarize one chunk of regions over all bigwigs as a float32 (regions x tracks) block"""
+    bws, idx, sub_regions, cache_opt = unit
+    block=np.empty((len(sub_regions),len(bws)),dtype=np.float32)
+    for i, bw in enumerate(bws):
+        bw_hander=pbw.open(bw)
+        cache=get_bin_cache(bw,cache_opt) if cache_opt else None
+        block[:,i]=get_bw_region_means(bw_hander,sub_regions,cache)
+        bw_hander.close()
+    return idx, block
+
+def load_regions(beds) -> pd.DataFrame:
     dfs=[]
     for bed in beds:
         logger.info(f"start loading bed file {bed}")
@@ -135,30 +316,58 @@ def process(beds,bws,projects,*args) -> pd.DataFrame:
     logger.info("All bed files are loaded. Start to merge")    
     regions=pd.concat(dfs)
 
-    tmp_name=f"bwcor_{abs(np.random.randn()*100)}.bed"
-    tmp_name_o=tmp_name+"out.bed"
-    regions.to_csv(tmp_name,sep="\t",header=False,index=False)
-    cmd=f"cat {tmp_name} | sort -k1,1 -k2,2n | bedtools merge -d -1 -i - > {tmp_name_o} "
-    os.system(cmd)
-    regions=pd.read_csv(tmp_name_o,sep="\t",names=["chr","start","end"])
-    os.remove(tmp_name)
-    os.remove(tmp_name_o)
-
-    odf={}
-    for bw,project in zip(bws,projects):
-        bw_hander=pbw.open(bw)
-        logger.info(f"start to process bigwig file {bw}")
-        odf[project]=regions.apply(lambda x: get_bw_stat(x,bw_hander), axis=1)
-        logger.info(f"end to process bigwig file {bw}")
+    regions=merge_regions(regions)
+    logger.info(f"{len(regions)} regions after merge")
+    return regions
+
+def process_streaming(chunks,bws,projects,threads=1,log1p=False,osname=None,ofs="\t",cache_opt=None) -> pd.DataFrame:
+    """accumulate pearson statistics over (positions, regions) chunks, write the summary matrix on the fly if osname is set"""
+    stats=init_corr_stats(len(bws))
+    fo=None
+    if osname:
+        fo=sys.stdout if osname=="std" else open(osname,'w',encoding='utf8')
+        fo.write(ofs+ofs.join(projects)+"\n")
+    units=((bws,idx,sub_regions,cache_opt) for idx,sub_regions in chunks)
+    logger.info(f"start to stream regions with {threads} processes")
+    pool=multiprocessing.Pool(threads) if threads > 1 else None
+    for idx, block in (pool.imap(scan_chunk, units) if pool else map(scan_chunk, units)):
+        update_corr_stats(stats,transform_block(block,log1p))
+        if fo:
+            pd.DataFrame(block,index=idx).to_csv(fo,sep=ofs,header=False,na_rep="")
+    if pool:
+        pool.close()
+        pool.join()
+    if fo and fo is not sys.stdout:
+        fo.close()
+    logger.info(f"all chunks are processed, {stats['n']} regions without na are used")
+    df_cor=corr_from_stats(stats,projects)
+    print(df_cor)
+    return df_cor
+
+def process(regions,bws,projects,na=NA,engine="stats",threads=1,method="pearson",log1p=False,cache_opt=None) -> pd.DataFrame:
+    odf={project:np.full(len(regions),np.nan) for project in projects}
+    chrom_idx=regions.groupby("chr",sort=False).indices
+    units=[(bw,project,engine,idx,regions.iloc[idx],cache_opt) for bw,project in zip(bws,projects) for idx in chrom_idx.values()]
+    logger.info(f"start to process {len(units)} (bigwig x chromosome) units with {threads} processes")
+    if threads > 1:
+        with multiprocessing.Pool(threads) as pool:
+            for project, idx, values in pool.imap_unordered(scan_unit, units):
+                odf[project][idx]=values
+    else:
+        for project, idx, values in map(scan_unit, units):
+            odf[project][idx]=values
+    logger.info("all bigwig files are processed")
     
-    odf=pd.DataFrame(odf)
+    odf=pd.DataFrame(odf,index=regions.index)
 
     p=odf.head().to_csv(sep="\t")
     logger.debug("stats example: \n## " +p.replace("\n","\n## "))
-    p=odf.dropna().copy()
-    for z in p.columns:
-        p.loc[:,z]=deepcopy(p[z].apply(float))
-    df_cor=p.corr(method ='pearson')
+    p=transform_block(odf.to_numpy(dtype=np.float64),log1p)
+    p=p[~np.isnan(p).any(axis=1)]
+    if method == "spearman":
+        p=rank_columns(p)
+    stats=update_corr_stats(init_corr_stats(len(odf.columns)),p)
+    df_cor=corr_from_stats(stats,list(odf.columns))
     print(df_cor)
     return df_cor,odf
 
@@ -181,10 +390,25 @@ if __name__ == '__main__':
     opt=generate_opt()
     arg=opt.parse_args()
     beds, bws, projects, na=validate_arg(arg)
-    odf_cor,odf=process(beds,bws,projects,na)
-    output(odf_cor,arg.oname,arg.ofs)
-    if arg.osname:
-        output(odf,arg.osname,arg.ofs)
+    cache_opt=cache_options(arg.cache_dir,arg.cache_binsize,int(arg.cache_size*1024**3),bws) if arg.cache_dir else None
+    if arg.bins > 0:
+        bw_hander=pbw.open(bws[0])
+        chroms=bw_hander.chroms()
+        bw_hander.close()
+        logger.info(f"tile {len(chroms)} chromosomes of {bws[0]} into {arg.bins}bp bins")
+    else:
+        regions=load_regions(beds)
+    if arg.chunk_size > 0:
+        chunks=iter_bin_chunks(chroms,arg.bins,arg.chunk_size) if arg.bins > 0 else iter_chunks(regions,arg.chunk_size)
+        odf_cor=process_streaming(chunks,bws,projects,threads=arg.threads,log1p=arg.log1p,osname=arg.osname,ofs=arg.ofs,cache_opt=cache_opt)
+        output(odf_cor,arg.oname,arg.ofs)
+    else:
+        if arg.bins > 0:
+            regions=tile_genome(chroms,arg.bins)
+        odf_cor,odf=process(regions,bws,projects,na,engine=arg.engine,threads=arg.threads,method=arg.method,log1p=arg.log1p,cache_opt=cache_opt)
+        output(odf_cor,arg.oname,arg.ofs)
+        if arg.osname:
+            output(odf,arg.osname,arg.ofs)
     logger.info("see you~")
     
 
@@ -8,85 +8,54 @@
 #   - numpy
 #   - pandas
 #   - numba
-#   - bedtools  (bedtools makewindows)
-#   - UCSCtools (bigWigAverageOverBed, bedGraphPack, bedGraphToBigWig)
+#   - pyBigWig
+#   - bw_bin_cache.py in this repo
 
 
 import os
 import sys
+import hashlib
 import pathlib
+import multiprocessing
 import click
 
 import numpy as np
 import numba as nb
 import pandas as pd
+import pyBigWig as pbw
 
+from bw_bin_cache import read_intervals, cumulative_signal, bigwig_fingerprint
 
-# use bedtools, generate the bin_bed from genome and resolution
-def generate_genome_window_bed(genome, resolution, bin_bed):
+
+# load the genome sizes file (chrom, size), keep its chromosome order
+def load_genome_sizes(genome):
     if not os.path.isfile(genome):
         raise FileNotFoundError("The genome file is not found: {}".format(genome))
-    if not os.path.isfile(bin_bed):
-        cmd = f'''bedtools makewindows -g {genome} -w {resolution} | awk 'BEGIN{{OFS="\t"}}{{$4=$1 "," $2 "," $3; print $0}}'> {bin_bed}'''
-        os.system(cmd)
-    else:
-        print("The windows file is already generated: {}".format(bin_bed))
-    return bin_bed
-
-# summarize the mnase signal from ibw in the bin_bed by bigWigAverageOverBed, to fix_step_signal_bed
-def summarize_mnase_signal(ibw, bin_bed, fix_step_signal_bed):
-    if not os.path.isfile(ibw):
-        raise FileNotFoundError("The mnase signal file is not found: {}".format(ibw))
-    if not os.path.isfile(bin_bed):
-        raise FileNotFoundError("The windows file is not found: {}".format(bin_bed))
-    if not os.path.isfile(fix_step_signal_bed):
-        cmd = f"bigWigAverageOverBed {ibw} {bin_bed} {fix_step_signal_bed}"
-        os.system(cmd)
-    else:
-        print("The fix step signal file is already generated: {}".format(fix_step_signal_bed))
-    return fix_step_signal_bed
-
-# turn output of bigWigAverageOverBed to a fixed step bedgraph  
-def fix_step_signal_bedgraph_from_bed(fix_step_signal_bed, fix_step_signal_bedgraph, nafill=True):
-    if not os.path.isfile(fix_step_signal_bed):
-        raise FileNotFoundError("The fix step signal file is not found: {}".format(fix_step_signal_bed))
-    if not os.path.isfile(fix_step_signal_bedgraph):
+    df = pd.read_csv(genome, sep="\t", header=None, usecols=[0, 1], names=["chr", "size"], comment="#")
+    return dict(zip(df["chr"].astype(str), df["size"].astype(int)))
+
+# summarize one chromosome of the bigwig into fixed step bins, read in blocks of intervals
+# nafill: uncovered bases count as 0 (mean0 of bigWigAverageOverBed), else mean of covered bases, 0 if none
+def get_fixed_step_signal(bw, chrom, size, resolution, nafill=True, block=10_000_000):
+    nbins = (size + resolution - 1) // resolution
+    signal = np.zeros(nbins, dtype=np.float32)
+    if chrom not in bw.chroms():
+        print("The chromosome is not in the mnase signal file, treat it as 0: {}".format(chrom))
+        return signal
+    size = min(size, bw.chroms(chrom))
+    block = max(block // resolution, 1) * resolution
+    for bstart in range(0, size, block):
+        bend = min(bstart + block, size)
+        edges = np.append(np.arange(bstart, bend, resolution), bend)
+        intervals = read_intervals(bw, chrom, bend, bstart)
+        sums, covs = cumulative_signal(edges, *intervals)
+        sums, covs = np.diff(sums), np.diff(covs)
         if nafill:
-            cmd = f'''cat  {fix_step_signal_bed} | cut -f 1,5 | tr $'\t' ',' > {fix_step_signal_bedgraph}'''
+            values = sums / np.diff(edges)
         else:
-            cmd = f'''cat  {fix_step_signal_bed} | cut -f 1,6 | tr $'\t' ',' > {fix_step_signal_bedgraph}'''
-        os.system(cmd)
-    else:
-        print("The fix step signal bedgraph file is already generated: {}".format(fix_step_signal_bedgraph))
-    return fix_step_signal_bedgraph
-
-# turn input ibw to a fixed step bedgraph
-def ibw_to_fixed_step_bedgraph(ibw,resolution, genome, project, odir, nafill=True):
-    ## steps: generate the bin_bed, summarize the mnase signal, generate the fix_step_signal_bed, turn it to a fixed step bedgraph
-
-    ## project is the stem of ibw filename
-    ## species is the stem of the genome file name
-    species = os.path.basename(genome).split(".")[0]
-    bin_bed = os.path.join(odir, species + "_" + str(resolution) + "bp.bed")
-    fix_step_signal_bed = os.path.join(odir, project + "_" + str(resolution) + "bp_fix_step_signal.bed")
-    fix_step_signal_bedgraph = os.path.join(odir, project + "_" + str(resolution) + "bp_fix_step_signal.bedgraph")
-
-    # if fix_step_signal_bedgraph exist, skip the step
-    if os.path.isfile(fix_step_signal_bedgraph):
-        print("The fix step signal bedgraph file is already generated: {}".format(fix_step_signal_bedgraph))
-    else:
-        ## generate the bin_bed
-        generate_genome_window_bed(genome, resolution, bin_bed)
-
-        ## summarize the mnase signal
-        summarize_mnase_signal(ibw, bin_bed, fix_step_signal_bed)
-
-        # turn output of bigWigAverageOverBed to a fixed step bedgraph
-        fix_step_signal_bedgraph_from_bed(fix_step_signal_bed, fix_step_signal_bedgraph, nafill=nafill)
-
-        ## rm fix_step_signal_bed
-        os.remove(fix_step_signal_bed)
-    return fix_step_signal_bedgraph
+            values = np.where(covs > 0, sums / np.maximum(covs, 1), 0)
+        signal[bstart // resolution: bstart // resolution + len(values)] = values
+    return signal
 
 # get gaussian smooth kernal
 def get_gaussian_smooth_kernal(win, bandwidth):
@@ -95,6 +64,46 @@ def get_gaussian_smooth_kernal(win, bandwidth):
     kernal = kernal/np.sum(kernal)
     return kernal
 
+# gaussian smooth by overlap-add FFT convolution in blocks, same output as np.convolve(mode="same") up to float error
+# the output is snapped to a grid just above the FFT rounding noise, so zero and flat stretches keep exact ties in the local max search;
+# near-ties that np.convolve itself breaks by summation order can still give a few different local maxs
+def fft_smooth(signal, kernal, block=1<<18):
+    m = len(kernal)
+    nfft = 1 << int(np.ceil(np.log2(block + m - 1)))
+    fkernal = np.fft.rfft(kernal, nfft)
+    out = np.zeros(len(signal) + m - 1)
+    for i in range(0, len(signal), block):
+        seg = signal[i:i+block]
+        out[i:i+len(seg)+m-1] += np.fft.irfft(np.fft.rfft(seg, nfft) * fkernal, nfft)[:len(seg)+m-1]
+    out = out[(m-1)//2:][:len(signal)]
+    tol = np.abs(signal).max() * np.finfo(np.float64).eps * m if len(signal) else 0
+    if tol > 0:
+        out = np.round(out / tol) * tol
+    return out
+
+# recursive gaussian smooth (Young & van Vliet, 1995), O(n) whatever the bandwidth
+# approximates an untruncated gaussian of sigma=band, signal outside the chromosome is 0
+@nb.jit(nopython=True)
+def recursive_gaussian_smooth(signal:np.array, band:float):
+    sigma = max(band, 0.5)
+    if sigma >= 2.5:
+        q = 0.98711*sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554*np.sqrt(1 - 0.26891*sigma)
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = (2.44413*q + 2.85619*q**2 + 1.26661*q**3)/b0
+    b2 = -(1.4281*q**2 + 1.26661*q**3)/b0
+    b3 = 0.422205*q**3/b0
+    B = 1 - (b1 + b2 + b3)
+    n = len(signal)
+    forward = np.zeros(n + 3)
+    for i in range(n):
+        forward[i+3] = B*signal[i] + b1*forward[i+2] + b2*forward[i+1] + b3*forward[i]
+    backward = np.zeros(n + 3)
+    for i in range(n-1, -1, -1):
+        backward[i] = B*forward[i+3] + b1*backward[i+1] + b2*backward[i+2] + b3*backward[i+3]
+    return backward[:n]
+
 # find localMax in given signal arrays
 @nb.jit(nopython=True)
 def find_local_max(signal:np.array, win:int):
@@ -106,6 +115,23 @@ def find_local_max(signal:np.array, win:int):
             local_maxs[i] = True
     return local_maxs
 
+# same as find_local_max in O(n): van Herk/Gil-Werman sliding max over blocks of 2*win+1
+@nb.jit(nopython=True)
+def find_local_max_sliding(signal:np.array, win:int):
+    n = len(signal)
+    k = 2*win + 1
+    prefix = np.empty(n)
+    suffix = np.empty(n)
+    for i in range(n):
+        prefix[i] = signal[i] if i % k == 0 else max(prefix[i-1], signal[i])
+    for i in range(n-1, -1, -1):
+        suffix[i] = signal[i] if (i == n-1 or (i+1) % k == 0) else max(suffix[i+1], signal[i])
+    local_maxs = np.zeros_like(signal)
+    for i in range(win, n-win):
+        if signal[i] == max(suffix[i-win], prefix[i+win]):
+            local_maxs[i] = True
+    return local_maxs
+
 # get array_value from signal and local_maxs
 @nb.jit(nopython=True)
 def __get_array_value(signal:np.array, localMax:np.array):
@@ -118,10 +144,8 @@ def __get_array_value(signal:np.array, localMax:np.array):
         array_values[a:b] = scores
     return array_values
 
-# load the fix_step_signal_bedgraph to a pandas dataframe, and calculate the array value
-def get_array_value(bedgraph,resolution, window, smooth_band):
-    # steps: load bedgraph, smooth, get diff and abs ,get local_maxs, get array_values
-
+# get the window and the smooth kernal in bins
+def get_smooth_params(resolution, window, smooth_band):
     # win is the window size // resolution
     win = window // resolution
     band = smooth_band // resolution
@@ -133,55 +157,212 @@ def get_array_value(bedgraph,resolution, window, smooth_band):
 
     ## get smooth kernal
     kernal = get_gaussian_smooth_kernal(win, band)
+    return win, band, kernal
+
+# smooth the fixed step signal of one chromosome
+# smoother: convolve (exact), fft (same values up to float error, a few local maxs may differ at near-ties) or recursive (approximate, O(n))
+def smooth_signal(signal, band, kernal, smoother="convolve"):
+    signal = signal.astype(np.float64)
+    if smoother == "fft":
+        return fft_smooth(signal, kernal)
+    elif smoother == "recursive":
+        return recursive_gaussian_smooth(signal, band)
+    ## same as np.convolve(mode="same"), but keeps the length for chromosomes shorter than the kernal
+    return np.convolve(signal, kernal, mode="full")[(len(kernal)-1)//2:][:len(signal)]
+
+# calculate the array value of one chromosome from its smoothed signal, also return the local max bins and their smoothed signal
+# local_max: sliding (O(n)) or naive (O(n*win)), both give the same maxima
+def get_array_value(smooth, win, local_max="sliding"):
+    # steps: get diff and abs ,get local_maxs, get array_values
+    diff = np.abs(np.diff(smooth, prepend=smooth[:1]))
+    if local_max == "naive":
+        local_maxs = find_local_max(diff, win)
+    else:
+        local_maxs = find_local_max_sliding(diff, win)
+    max_index = np.flatnonzero(local_maxs)
+    return __get_array_value(smooth, local_maxs).astype(np.float32), max_index, smooth[max_index]
+
+# cache directory of one bigwig at one resolution and na filling:
+# <cache_dir>/<bigwig stem>.<key>.<resolution>bp, key is built from the bigwig fingerprint (size, mtime, head/tail checksum)
+def get_cache_entry(cache_dir, ibw, resolution, nafill):
+    key = hashlib.sha1(f"{bigwig_fingerprint(ibw)}|{resolution}|{nafill}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(ibw).split('.')[0]}.{key}.{resolution}bp")
+
+# load a cached array, a missing or unreadable file is a miss
+def load_cached(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        return np.load(path)
+    except (ValueError, OSError, EOFError):
+        print("The cache file is broken, recompute it: {}".format(path))
+        return None
+
+# write a cached array atomically, so a killed job never leaves a partial file behind
+def save_cached(path, array):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+# one (sample, chromosome) as a unit: read its signal and get its array value
+# with a cache entry, the fixed step signal and the smoothed signal are reused or stored per chromosome,
+# so new window/bandwidth/smoother only redo the smoothing, and a new local max method only the last step
+def chrom_array_value(unit):
+    sample, ibw, chrom, size, resolution, nafill, win, band, kernal, smoother, local_max, entry = unit
+    smooth_cache = os.path.join(entry, f"{chrom}.{size}.smooth.{smoother}.{win}w.{band}b.npy") if entry else None
+    smooth = load_cached(smooth_cache) if entry else None
+    if smooth is None:
+        signal_cache = os.path.join(entry, f"{chrom}.{size}.signal.npy") if entry else None
+        signal = load_cached(signal_cache) if entry else None
+        if signal is None:
+            print("Summarizing the mnase signal of {} {} in {}bp bins...".format(sample, chrom, resolution))
+            bw = pbw.open(ibw)
+            signal = get_fixed_step_signal(bw, chrom, size, resolution, nafill=nafill)
+            bw.close()
+            if entry:
+                save_cached(signal_cache, signal)
+        smooth = smooth_signal(signal, band, kernal, smoother)
+        if entry:
+            save_cached(smooth_cache, smooth)
+    else:
+        print("Reuse the cached smoothed signal of {} {}: {}".format(sample, chrom, smooth_cache))
+    print("Get array_value of {} {}...".format(sample, chrom))
+    return (sample, chrom, *get_array_value(smooth, win, local_max))
+
+# yield (sample, chrom, array_value, max_index, max_smooth) one chromosome at a time, chromosome-major in the genome order and then by sample
+# so every sample gets its chromosomes in the genome order, units run in a process pool
+def iter_array_values(samples, chrom_sizes, resolution, window, smooth_band, nafill=True, threads=1, smoother="convolve", local_max="sliding", cache_dir=None):
+    for ibw in samples.values():
+        if not os.path.isfile(ibw):
+            raise FileNotFoundError("The mnase signal file is not found: {}".format(ibw))
+    win, band, kernal = get_smooth_params(resolution, window, smooth_band)
     print("The gaussian smooth kernal is: {}".format(kernal))
-    
-    print("Loading bedgraph file: {}".format(bedgraph))
-    df = pd.read_csv(bedgraph, sep=",", header=None, names=["chr", "start", "end", "value"])
-    df["value"] = df["value"].astype(float)
-
-    print("Smoothing the signal...")
-    df["smooth"] = np.convolve(df["value"], kernal, mode="same")
-    df["diff"] = np.abs(df["smooth"].diff().fillna(0))
-
-    print("Get array_value...")
-    df["local_max"] = find_local_max(np.array(df["diff"]), win)
-    df["array_value"] = __get_array_value(np.array(df["smooth"]), np.array(df["local_max"]))
+    entries = {sample: get_cache_entry(cache_dir, ibw, resolution, nafill) if cache_dir else None for sample, ibw in samples.items()}
+    units = [(sample, ibw, chrom, size, resolution, nafill, win, band, kernal, smoother, local_max, entries[sample]) for chrom, size in chrom_sizes.items() if size > 0 for sample, ibw in samples.items()]
+    if threads > 1:
+        with multiprocessing.Pool(threads) as pool:
+            yield from pool.imap(chrom_array_value, units)
+    else:
+        yield from map(chrom_array_value, units)
+
+# collapse runs of equal values in a fixed step array to (starts, ends, values) entries, like bedGraphPack
+def collapse_runs(values, resolution, size):
+    change = np.flatnonzero(values[1:] != values[:-1]) + 1
+    first = np.concatenate([[0], change])
+    starts = first.astype(np.int64) * resolution
+    ends = np.append(change.astype(np.int64) * resolution, size)
+    return starts, ends, values[first]
+
+# distribution of the array value of one chromosome in one sample
+def summarize_array_value(sample, chrom, array_value):
+    q = np.quantile(array_value, [0, 0.25, 0.5, 0.75, 1]) if len(array_value) else [np.nan]*5
+    return {"sample": sample, "chr": chrom, "bins": len(array_value), "mean": array_value.mean(dtype=np.float64) if len(array_value) else np.nan,
+            "std": array_value.std(dtype=np.float64) if len(array_value) else np.nan, "min": q[0], "q25": q[1], "median": q[2], "q75": q[3], "max": q[4],
+            "nonzero": np.count_nonzero(array_value)}
+
+# load the regions bed, keep its first 6 columns
+def load_regions(regions):
+    df = pd.read_csv(regions, sep="\t", header=None, comment="#")
+    if len(df.columns) < 3:
+        raise ValueError("The regions bed must contain at least 3 columns: {}".format(regions))
+    df = df.iloc[:, :6]
+    df.columns = ["chr", "start", "end", "name", "score", "strand"][:len(df.columns)]
+    df["chr"] = df["chr"].astype(str)
     return df
 
-# get the array value from the fix_step_signal_bedgraph, and output as a bedgraph, then pack it, finally output as a bigwig
-def get_array_value_bedgraph(fix_step_signal_bedgraph, resolution, window, smooth_band, project, odir,genome):
-    # steps: get array value, output a tmp bedGraph, then pack it, output a bigwig, rm tmp bedGraph
-
-    df = get_array_value(fix_step_signal_bedgraph, resolution, window, smooth_band)
-    tmp_bedgraph = os.path.join(odir, project + "_tmp_array_value.bedgraph")
-    print("Outputing the array value bedgraph file: {}".format(tmp_bedgraph))
-    df[["chr","start","end","array_value"]].to_csv(tmp_bedgraph, sep="\t", header=False, index=False)
-
-    # pack the tmp bedgraph
-    print("Packing the array value bedgraph file...")
-    tmp_bedgraph_packed = os.path.join(odir, project + "_tmp_array_value.packed.bedgraph")
-    cmd = f'''bedGraphPack {tmp_bedgraph} {tmp_bedgraph_packed}'''
-    os.system(cmd)
-
-    # sort bedgraph
-    print("Sorting the array value bedgraph file...")
-    tmp_bedgraph_sorted = os.path.join(odir, project + "_tmp_array_value.sorted.bedgraph")
-    cmd = f'''sort -k1,1 -k2,2n {tmp_bedgraph_packed} > {tmp_bedgraph_sorted}'''
-    os.system(cmd)
-
-
-    ## output the bigwig
-    print("Outputing the bigwig file...")
-    bw = os.path.join(odir, project + f".{resolution}bp" + ".array_value.bw")
-    cmd = f'''bedGraphToBigWig {tmp_bedgraph_sorted} {genome} {bw}'''
-    os.system(cmd)
-
-    ## rm tmps
-    print("Removing the tmp files...")
-    os.remove(tmp_bedgraph)
-    os.remove(tmp_bedgraph_sorted)
-    os.remove(tmp_bedgraph_packed)
-    return bw
+# base-weighted mean array value and local max (nucleosome dyad, taken at the bin center) count of regions on one chromosome
+def summarize_regions(starts, ends, array_value, max_index, resolution, size):
+    starts = np.clip(starts, 0, size).astype(np.float64)
+    ends = np.clip(ends, 0, size).astype(np.float64)
+    csum = np.concatenate([[0.0], np.cumsum(array_value * np.diff(np.append(np.arange(len(array_value)) * resolution, size)))])
+    def cumulative(pos):
+        b = np.minimum(pos // resolution, len(array_value) - 1).astype(np.int64)
+        return csum[b] + (pos - b * resolution) * array_value[b]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(ends > starts, (cumulative(ends) - cumulative(starts)) / (ends - starts), np.nan)
+    centers = max_index * resolution + np.minimum(resolution, size - max_index * resolution) / 2
+    counts = np.searchsorted(centers, ends, side="left") - np.searchsorted(centers, starts, side="left")
+    return means, counts
+
+# get the array value chromosome by chromosome, write one bigwig per sample in the genome order, and a per-chromosome summary table
+# regions: bed to report the mean array value and nucleosome count per region of every sample, in the same pass
+# nucleosomes: also export the local max bins of every sample as a bed of called nucleosome positions
+def get_array_value_bigwig(samples, resolution, window, smooth_band, project, odir, genome, nafill=True, threads=1, smoother="convolve", local_max="sliding", regions=None, nucleosomes=False, cache_dir=None, chunk=1_000_000):
+    chrom_sizes = {chrom: size for chrom, size in load_genome_sizes(genome).items() if size > 0}
+    if regions:
+        df_regions = load_regions(regions)
+        region_idx = df_regions.groupby("chr", sort=False).indices
+        region_starts = df_regions["start"].to_numpy(dtype=np.int64)
+        region_ends = df_regions["end"].to_numpy(dtype=np.int64)
+        region_values = {}
+        for sample in samples:
+            region_values[f"{sample}.array_value"] = np.full(len(df_regions), np.nan)
+            region_values[f"{sample}.nucleosomes"] = np.full(len(df_regions), np.nan)
+        missing = set(region_idx) - set(chrom_sizes)
+        if missing:
+            print("The regions on these chromosomes are not in the genome file, treat them as nan: {}".format(sorted(missing)))
+    nuc_beds = {}
+    if nucleosomes:
+        for sample in samples:
+            nuc_beds[sample] = os.path.join(odir, sample + f".{resolution}bp" + ".nucleosomes.bed")
+            print("Outputing the nucleosome bed file: {}".format(nuc_beds[sample]))
+            open(nuc_beds[sample], "w").close()
+    obws, writers = {}, {}
+    for sample in samples:
+        obws[sample] = os.path.join(odir, sample + f".{resolution}bp" + ".array_value.bw")
+        print("Outputing the bigwig file: {}".format(obws[sample]))
+        writers[sample] = pbw.open(obws[sample], "w")
+        writers[sample].addHeader(list(chrom_sizes.items()), maxZooms=10)
+    summary = []
+    for sample, chrom, array_value, max_index, max_smooth in iter_array_values(samples, chrom_sizes, resolution, window, smooth_band, nafill, threads, smoother, local_max, cache_dir):
+        summary.append(summarize_array_value(sample, chrom, array_value))
+        if regions and chrom in region_idx:
+            idx = region_idx[chrom]
+            means, counts = summarize_regions(region_starts[idx], region_ends[idx], array_value, max_index, resolution, chrom_sizes[chrom])
+            region_values[f"{sample}.array_value"][idx] = means
+            region_values[f"{sample}.nucleosomes"][idx] = counts
+        if nucleosomes:
+            nuc_starts = max_index.astype(np.int64) * resolution
+            pd.DataFrame({"chr": chrom, "start": nuc_starts, "end": np.minimum(nuc_starts + resolution, chrom_sizes[chrom]), "name": ".", "score": max_smooth}).to_csv(nuc_beds[sample], mode="a", sep="\t", header=False, index=False)
+        starts, ends, values = collapse_runs(array_value, resolution, chrom_sizes[chrom])
+        print("Writing {} entries of {} {}...".format(len(starts), sample, chrom))
+        for i in range(0, len(starts), chunk):
+            n = len(starts[i:i+chunk])
+            writers[sample].addEntries([chrom]*n, starts[i:i+chunk].tolist(), ends=ends[i:i+chunk].tolist(), values=values[i:i+chunk].astype(np.float64).tolist())
+    for writer in writers.values():
+        writer.close()
+    osummary = os.path.join(odir, project + f".{resolution}bp" + ".array_value.summary.tsv")
+    print("Outputing the summary table: {}".format(osummary))
+    pd.DataFrame(summary).to_csv(osummary, sep="\t", index=False, na_rep="nan")
+    if regions:
+        oregions = os.path.join(odir, project + f".{resolution}bp" + ".array_value.regions.tsv")
+        print("Outputing the region table: {}".format(oregions))
+        df_values = pd.DataFrame(region_values)
+        for sample in samples:
+            df_values[f"{sample}.nucleosomes"] = df_values[f"{sample}.nucleosomes"].astype("Int64")
+        pd.concat([df_regions, df_values], axis=1).to_csv(oregions, sep="\t", index=False, na_rep="nan")
+    return obws
+
+# samples from -i bigwigs and the sample sheet (name<TAB>bigwig, or bigwig only per line), names default to bigwig stems
+def load_samples(ibws, sample_sheet=None):
+    pairs = [(os.path.basename(ibw).split(".")[0], ibw) for ibw in ibws]
+    if sample_sheet:
+        with open(sample_sheet) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if len(fields) == 1:
+                    pairs.append((os.path.basename(fields[0]).split(".")[0], fields[0]))
+                else:
+                    pairs.append((fields[0], fields[1]))
+    names = [name for name, _ in pairs]
+    if len(set(names)) != len(names):
+        pairs = [(f"{i}_{name}", ibw) for i, (name, ibw) in enumerate(pairs)]
+        print("The sample names are duplicated, use {} as sample names".format([name for name, _ in pairs]))
+    return dict(pairs)
 
 
 
@@ -189,23 +370,33 @@ def get_array_value_bedgraph(fix_step_signal_bedgraph, resolution, window, smoot
 
 ## get params from command line
 @click.command(help="The script is used to calculate the array value from mnase signal. See doi:10/f5q8qx")
-@click.option('-i','--ibw',type=click.Path(exists=True), help='The mnase signal file in bigwig format')
+@click.option('-i','--ibw',type=click.Path(exists=True), multiple=True, help='The mnase signal file in bigwig format, repeat it for many samples')
+@click.option('-s','--samples','sample_sheet',type=click.Path(exists=True), default=None, help='The sample sheet, one sample per line: name<TAB>bigwig, or bigwig only')
 @click.option('-r','--resolution',type=int, help='The resolution of the windows')
-@click.option('-g','--genome',type=click.Path(), help='The genome file in fasta format')
+@click.option('-g','--genome',type=click.Path(), help='The genome sizes file (chrom, size)')
 @click.option('-o','--odir',type=click.Path(), default=os.getcwd(),help='The output directory')
-@click.option('-p','--project',default="",help='The project name')
+@click.option('-p','--project',default="",help='The project name. Names the bigwig of a single sample, and the summary table')
 @click.option('-w','--window',type=int, default=73,help='The half window size. Default is 73bp, half of DNA len in histone')
 @click.option('-b','--bandwidth',type=int, default=30,help='The bandwidth of the gaussian smooth')
 @click.option('-n','--nonafill',is_flag=True,flag_value=False, help='Whether to fill the NA value with 0', default=True)
-def main(ibw, resolution, genome, odir, project, window, bandwidth, nonafill):
-    if len(project.strip())==0:
-        project = os.path.basename(ibw).split(".")[0]
-    else:
-        project = project.strip()
-    bdg = ibw_to_fixed_step_bedgraph(ibw, resolution, genome, project, odir, nafill=not(nonafill))
-    get_array_value_bedgraph(bdg, resolution, window, bandwidth, project, odir, genome)
+@click.option('-t','--threads',type=int, default=1,help='The processes to run (sample, chromosome) units in parallel')
+@click.option('--smoother',type=click.Choice(["convolve","fft","recursive"]), default="convolve",help='The gaussian smooth method. fft matches convolve up to float error but may call a few different local maxs at near-ties, recursive is an O(n) approximation; both are fast on 1bp resolution')
+@click.option('--local-max','local_max',type=click.Choice(["sliding","naive"]), default="sliding",help='The local max method. sliding is O(n), naive is O(n*window); results are the same')
+@click.option('--regions',type=click.Path(exists=True), default=None,help='The bed regions (e.g. promoters) to report the mean array value and the local max (nucleosome) count of every sample')
+@click.option('--nucleosomes',is_flag=True, default=False,help='Also output the local max bins of every sample as a bed of called nucleosome positions')
+@click.option('--cache-dir','cache_dir',type=click.Path(), default=None,help='The directory to cache per-chromosome signal and smoothed arrays, keyed by the bigwig content and parameters')
+def main(ibw, sample_sheet, resolution, genome, odir, project, window, bandwidth, nonafill, threads, smoother, local_max, regions, nucleosomes, cache_dir):
+    samples = load_samples(ibw, sample_sheet)
+    if len(samples) == 0:
+        raise click.UsageError("At least one mnase signal file is needed, check -i and -s")
+    project = project.strip()
+    if len(samples) == 1 and len(project) > 0:
+        samples = {project: list(samples.values())[0]}
+    if len(project) == 0:
+        project = list(samples)[0] if len(samples) == 1 else "samples"
+    os.makedirs(odir, exist_ok=True)
+    get_array_value_bigwig(samples, resolution, window, bandwidth, project, odir, genome, nafill=not(nonafill), threads=threads, smoother=smoother, local_max=local_max, regions=regions, nucleosomes=nucleosomes, cache_dir=cache_dir)
     print("Done!")
 
 if __name__ == "__main__":
     main()
-
@@ -3,184 +3,503 @@
 
 import os
 import sys
+import argparse
 import pysam
 import twobitreader
 import math
+import shutil
+import tempfile
 import subprocess
+import multiprocessing
+import numpy as np
 import pandas as pd
-from scipy.stats import binom_test
+from scipy.stats import binom
 from scipy.stats import fisher_exact
 import pathlib
 
-def split_bam_file(bamF,snpF,strain1,strain2,mix):
-	snp = {}
-	for line in open(snpF,'r'):
-		if line.startswith("#"):
-			continue
-		line = line.strip().split('\t')
-		if not line[0].startswith("chr"):
-			line[0]=f"chr{line[0]}"
-		if line[0] not in snp:
-				snp[line[0]] = {}
-		snp[line[0]][int(line[1])] = [line[3],line[4]]
-
-	votes = {}
-	match, unmatch = 0,0
+# bitmask of each base, alleles like A;T are stored as the OR of their bases
+BASE_CODE = {'A':1, 'C':2, 'G':4, 'T':8, 'N':16}
+
+def allele_mask(alleles):
+	mask = 0
+	for allele in str(alleles).split(';'):
+		mask |= BASE_CODE.get(allele, 0)
+	return mask
+
+
+class SnpIndex:
+	"""per chromosome sorted 0-based SNP positions (int32) and strain1/strain2 allele bitmasks (uint8)"""
+
+	def __init__(self, positions, alleles1, alleles2):
+		self.positions = positions
+		self.alleles1 = alleles1
+		self.alleles2 = alleles2
+
+	@classmethod
+	def from_text(cls, snpF, add_chr=True, chunksize=1<<22):
+		# snp file: chr, 1-based pos, id, strain1 alleles, strain2 alleles; a later line of the same position wins
+		parts = {}
+		for df in pd.read_csv(snpF, sep='\t', header=None, comment='#', usecols=[0,1,3,4], dtype={0:str, 1:np.int64, 3:'category', 4:'category'}, chunksize=chunksize):
+			if add_chr:
+				df[0] = df[0].where(df[0].str.startswith('chr'), 'chr' + df[0])
+			pos = (df[1].to_numpy() - 1).astype(np.int32)
+			a1 = df[3].map(allele_mask).to_numpy(dtype=np.uint8)
+			a2 = df[4].map(allele_mask).to_numpy(dtype=np.uint8)
+			for chrom, idx in df.groupby(0, sort=False).indices.items():
+				parts.setdefault(chrom, []).append((pos[idx], a1[idx], a2[idx]))
+		positions, alleles1, alleles2 = {}, {}, {}
+		for chrom, chunks in parts.items():
+			pos, a1, a2 = [np.concatenate(i) for i in zip(*chunks)]
+			order = np.argsort(pos, kind='stable')
+			pos, a1, a2 = pos[order], a1[order], a2[order]
+			keep = np.append(pos[1:] != pos[:-1], True)
+			positions[chrom], alleles1[chrom], alleles2[chrom] = pos[keep], a1[keep], a2[keep]
+		return cls(positions, alleles1, alleles2)
+
+	@classmethod
+	def load(cls, npz):
+		with np.load(npz) as data:
+			chroms, offsets = data['chroms'], data['offsets']
+			pos, a1, a2 = data['positions'], data['alleles1'], data['alleles2']
+		bounds = list(zip(chroms, offsets[:-1], offsets[1:]))
+		return cls({str(c):pos[s:e] for c,s,e in bounds}, {str(c):a1[s:e] for c,s,e in bounds}, {str(c):a2[s:e] for c,s,e in bounds})
+
+	@classmethod
+	def open(cls, snpF, add_chr=True):
+		# a saved .npz index is used as is, otherwise the snp text file is parsed
+		if str(snpF).endswith('.npz'):
+			return cls.load(snpF)
+		return cls.from_text(snpF, add_chr=add_chr)
+
+	def save(self, npz):
+		chroms = list(self.positions)
+		offsets = np.concatenate([[0], np.cumsum([len(self.positions[c]) for c in chroms])]).astype(np.int64)
+		np.savez(npz, chroms=np.array(chroms, dtype=str), offsets=offsets,
+			positions=np.concatenate([self.positions[c] for c in chroms]) if chroms else np.zeros(0, dtype=np.int32),
+			alleles1=np.concatenate([self.alleles1[c] for c in chroms]) if chroms else np.zeros(0, dtype=np.uint8),
+			alleles2=np.concatenate([self.alleles2[c] for c in chroms]) if chroms else np.zeros(0, dtype=np.uint8))
+
+	def __len__(self):
+		return sum(len(i) for i in self.positions.values())
+
+	def span(self, chrom, start, end):
+		# index range of SNPs in [start, end) on 0-based reference coordinates
+		if chrom not in self.positions:
+			return 0, 0
+		pos = self.positions[chrom]
+		return np.searchsorted(pos, start, side='left'), np.searchsorted(pos, end, side='left')
+
+
+# bitmask of every byte of a read sequence
+BASE_LUT = np.zeros(256, dtype=np.uint8)
+for base, code in BASE_CODE.items():
+	BASE_LUT[ord(base)] = code
+
+
+def read_votes(line, snp, min_qual=30):
+	# strain1 votes, strain2 votes and unmatched SNP bases of one read, bases under min_qual are skipped
+	# SNPs inside the reference span are mapped to query bases through the aligned (M/=/X) cigar blocks,
+	# SNPs under deletions and skipped regions have no base and are ignored
+	chr = line.reference_name
+	if line.is_unmapped or not line.cigartuples or line.query_sequence is None or line.query_qualities is None or chr not in snp.positions:
+		return 0, 0, 0
+	lo, hi = snp.span(chr, line.reference_start, line.reference_end)
+	if lo == hi:
+		return 0, 0, 0
+	ref_starts, query_starts, lengths = [], [], []
+	ref, query = line.reference_start, 0
+	for op, length in line.cigartuples:
+		if op in (0, 7, 8):
+			ref_starts.append(ref)
+			query_starts.append(query)
+			lengths.append(length)
+			ref += length
+			query += length
+		elif op in (1, 4):
+			query += length
+		elif op in (2, 3):
+			ref += length
+	ref_starts = np.array(ref_starts)
+	pos = snp.positions[chr][lo:hi]
+	block = np.searchsorted(ref_starts, pos, side='right') - 1
+	offset = pos - ref_starts[block]
+	aligned = (block >= 0) & (offset < np.array(lengths)[block])
+	qpos = (np.array(query_starts)[block] + offset)[aligned]
+	keep = np.asarray(line.query_qualities)[qpos] >= min_qual
+	codes = BASE_LUT[np.frombuffer(line.query_sequence.encode(), dtype=np.uint8)[qpos[keep]]]
+	is1 = (codes & snp.alleles1[chr][lo:hi][aligned][keep]) > 0
+	is2 = ~is1 & ((codes & snp.alleles2[chr][lo:hi][aligned][keep]) > 0)
+	v1, v2 = int(is1.sum()), int(is2.sum())
+	return v1, v2, len(codes) - v1 - v2
+
+
+# allele labels of read names, indexed by AlleleCaller.classify: unassigned, strain1, strain2, conflict
+LABELS = ['UA', 'G1', 'G2', 'CF']
+REPORT_COLUMNS = ['reads', 'reads_with_snp', 'snp_bases', 'strain1_bases', 'strain2_bases', 'unmatched_bases'] + LABELS
+# tag of the shard votes carried by pending records of split_reads_parallel, removed before the records are written
+SHARD_VOTES_TAG = 'xv'
+
+
+class AlleleCaller:
+	"""votes reads on the SNP index, classifies read names by their vote fractions, and counts per chromosome statistics"""
+
+	def __init__(self, snp, strain1_frac=2.0/3, strain2_frac=1.0/3, min_qual=30):
+		self.snp = snp
+		self.strain1_frac = strain1_frac
+		self.strain2_frac = strain2_frac
+		self.min_qual = min_qual
+		self.stats = {}
+
+	def _chrom(self, line):
+		chrom = line.reference_name or '*'
+		if chrom not in self.stats:
+			self.stats[chrom] = dict.fromkeys(REPORT_COLUMNS, 0)
+		return self.stats[chrom]
+
+	def votes(self, line):
+		v1, v2, unmatch = read_votes(line, self.snp, self.min_qual)
+		stat = self._chrom(line)
+		stat['reads'] += 1
+		stat['reads_with_snp'] += (v1 + v2 + unmatch) > 0
+		stat['snp_bases'] += v1 + v2 + unmatch
+		stat['strain1_bases'] += v1
+		stat['strain2_bases'] += v2
+		stat['unmatched_bases'] += unmatch
+		return v1, v2, unmatch
+
+	# 0: no votes, 1: strain1, 2: strain2, 3: conflict (mixed)
+	def classify(self, votes):
+		if sum(votes) == 0:
+			return 0
+		if votes[0]*1.0/sum(votes) >= self.strain1_frac:
+			return 1
+		elif votes[0]*1.0/sum(votes) <= self.strain2_frac:
+			return 2
+		return 3
+
+	def count(self, line, cls):
+		self._chrom(line)[LABELS[cls]] += 1
+
+	def merge(self, stats):
+		# add the statistics of another caller, e.g. of a shard worker
+		for chrom, stat in stats.items():
+			if chrom not in self.stats:
+				self.stats[chrom] = dict.fromkeys(REPORT_COLUMNS, 0)
+			for key, value in stat.items():
+				self.stats[chrom][key] += value
+
+	def total(self, key):
+		return sum(stat[key] for stat in self.stats.values())
+
+	def report(self, prefix):
+		df = pd.DataFrame.from_dict(self.stats, orient='index', columns=REPORT_COLUMNS)
+		df.loc['total'] = df.sum()
+		df['assign_rate'] = (df['G1'] + df['G2']) / df['reads'].where(df['reads'] > 0)
+		df['conflict_rate'] = df['CF'] / df['reads'].where(df['reads'] > 0)
+		df.index.name = 'chr'
+		df.to_csv(f"{prefix}.tsv", sep='\t', na_rep='nan')
+		df.reset_index().to_json(f"{prefix}.json", orient='records', indent=1)
+		print("report of SNP hits and assignments:", f"{prefix}.tsv", f"{prefix}.json")
+
+
+class SplitWriter:
+	"""writes the records of decided read names to strain1/strain2/mixed bams, or to one bam with an allele tag (G1/G2/CF/UA)"""
+
+	def __init__(self, outnames, header, caller, tag=None):
+		self.caller = caller
+		self.tag = tag
+		self.overwritten = 0
+		self.outfs = [pysam.Samfile(name,'wb',header=header) for name in outnames]
+
+	def write(self, lines, votes):
+		cls = self.caller.classify(votes)
+		for line in lines:
+			self.caller.count(line, cls)
+			if self.tag:
+				if line.has_tag(self.tag):
+					if not self.overwritten:
+						print(f"Warning: input reads already carry the {self.tag} tag, it is overwritten by the allele label, e.g.", line.qname)
+					self.overwritten += 1
+				line.set_tag(self.tag, LABELS[cls], value_type='Z')
+				self.outfs[0].write(line)
+			elif cls:
+				self.outfs[cls-1].write(line)
+
+	def close(self):
+		if self.overwritten:
+			print(f"Warning: the {self.tag} tag of", self.overwritten, "reads is overwritten, choose an unused tag")
+		for outf in self.outfs:
+			outf.close()
+
+
+class PendingTemplate:
+	"""records and votes of one read name, complete once its primary reads (and with expect_supplementary, the supplementaries listed in their SA tags) are seen"""
+
+	def __init__(self, expect_supplementary=True):
+		self.votes = [0, 0]
+		self.lines = []
+		self.primaries = set()
+		self.supplementary = 0
+		self.supplementary_expected = 0
+		self.expect_supplementary = expect_supplementary
+
+	def add(self, line, v1, v2):
+		self.votes[0] += v1
+		self.votes[1] += v2
+		self.lines.append(line)
+		if line.is_supplementary:
+			self.supplementary += 1
+		elif not line.is_secondary:
+			self.primaries.add(line.flag & 192)
+			if self.expect_supplementary and line.has_tag('SA'):
+				self.supplementary_expected += line.get_tag('SA').rstrip(';').count(';') + 1
+
+	def complete(self):
+		segments = {64, 128} if self.lines[0].is_paired else {0}
+		return self.primaries >= segments and self.supplementary >= self.supplementary_expected
+
+
+# a secondary or supplementary read starting no template is decided by its own votes: its template may be written already,
+# or its primary reads may still be to come (in coordinate order secondaries often come first), and its votes do not count
+# toward the template. only a supplementary before its primary in coordinate order (the first SA entry of a supplementary
+# is its primary) opens the template
+def is_orphan(line, coordinate=False):
+	if line.is_secondary:
+		return True
+	if not line.is_supplementary:
+		return False
+	if not (coordinate and line.has_tag('SA')):
+		return True
+	chrom, pos = line.get_tag('SA').split(',')[:2]
+	tid = line.header.get_tid(chrom)
+	return tid < 0 or (tid, int(pos)-1) < (line.reference_id, line.reference_start)
+
+
+# vote reads in order, write each template as soon as it is complete, return the templates still pending at the end
+# orphan records are decided at once by their own votes instead of waiting until the end, so strain calls of templates
+# with secondaries can differ from the two-pass mode; as orders other than by coordinate
+# cannot tell where the supplementaries are, their templates only wait for the primary reads.
+# with hold_orphans (shards), orphans stay pending, the rest of their template may be in another shard
+def split_pending(lines, caller, writer, coordinate=False, hold_orphans=False):
+	pending = {}
+	for line in lines:
+		v1, v2, un = caller.votes(line)
+		template = pending.get(line.qname)
+		if template is None:
+			if not hold_orphans and is_orphan(line, coordinate):
+				writer.write([line], (v1, v2))
+				continue
+			template = pending[line.qname] = PendingTemplate(coordinate)
+		template.add(line, v1, v2)
+		if template.complete():
+			writer.write(template.lines, template.votes)
+			del pending[line.qname]
+	return pending
+
+
+# decide read name groups one at a time, vote(line) gives the (strain1, strain2) votes of a record; returns the number of groups
+def split_name_groups(lines, writer, vote):
+	qname, group, votes, n = None, [], [0, 0], 0
+	for line in lines:
+		if line.qname != qname:
+			writer.write(group, votes)
+			qname, group, votes, n = line.qname, [], [0, 0], n + 1
+		v1, v2 = vote(line)
+		votes[0] += v1
+		votes[1] += v2
+		group.append(line)
+	writer.write(group, votes)
+	return n
+
+
+def is_name_grouped(header):
+	hd = header.to_dict().get('HD', {})
+	return hd.get('SO') == 'queryname' or hd.get('GO') == 'query'
+
+
+# split reads of bamF to the output bams by the votes of their read name
+# two-pass: vote all reads first, then write; votes of every read name are kept in memory
+# single-pass: name sorted/grouped input is decided per name group, other orders keep only templates whose mates are pending,
+#   secondary and supplementary alignments opening no template (see is_orphan) are assigned by their own votes,
+#   so strain calls of templates with secondaries can differ from two-pass,
+#   and the output of non name grouped input is no longer sorted
+def split_reads(bamF, caller, outnames, single_pass=False, tag=None):
+	infile = pysam.Samfile(bamF,'rb')
+	header = infile.header.to_dict()
+	grouped = is_name_grouped(infile.header)
+	coordinate = header.get('HD', {}).get('SO') == 'coordinate'
+	if single_pass and not grouped:
+		header.setdefault('HD', {'VN':'1.6'})['SO'] = 'unsorted'
+	writer = SplitWriter(outnames, header, caller, tag)
+
+	if not single_pass:
+		votes = {}
+		for line in infile:
+			if line.qname not in votes:
+					votes[line.qname] = [0,0]
+			v1, v2, un = caller.votes(line)
+			votes[line.qname][0] += v1
+			votes[line.qname][1] += v2
+		for line in pysam.Samfile(bamF,'rb'):
+			writer.write([line], votes[line.qname])
+	elif grouped:
+		print("single pass over the read name groups of", bamF)
+		split_name_groups(infile, writer, lambda line: caller.votes(line)[:2])
+	else:
+		print("single pass over", bamF, "keeping templates with pending mates")
+		pending = split_pending(infile, caller, writer, coordinate)
+		print(len(pending), "templates are not complete at the end, decided by their own records")
+		for template in pending.values():
+			writer.write(template.lines, template.votes)
+	writer.close()
+	infile.close()
+
+
+_worker_caller = None
+
+def init_shard_worker(snp_npz, strain1_frac, strain2_frac, min_qual):
+	global _worker_caller
+	_worker_caller = AlleleCaller(SnpIndex.load(snp_npz), strain1_frac, strain2_frac, min_qual)
+
+
+# split one region of an indexed bam into its own output bams, templates not complete inside the region
+# (mates or supplementaries in other shards) are written to a pending bam, their votes in the shard tagged on their first record
+def split_shard(unit):
+	bamF, chrom, start, end, prefix, nout, tag = unit
+	_worker_caller.stats = {}
 	infile = pysam.Samfile(bamF,'rb')
-	for line in infile:
-		if line.qname not in votes:
-				votes[line.qname] = [0,0]
-		# print(line.rname)
-		chr = line.reference_name
-		start = line.pos + 1
-		if line.cigar:
-			read = ''
-			score = ''
-			index = 0
-			for cg in line.cigar:
-				if cg[0] == 0:
-					read += line.seq[index:(index+cg[1])]
-					score += line.qual[index:(index+cg[1])]
-					index += cg[1]
-				elif cg[0] == 2:
-					read += 'N'*cg[1]
-					score += '!'*cg[1]
-					index += cg[1]
-				else:
-					index += cg[1]
-			for pos in range(0,len(read)):
-				if chr in snp and start+pos in snp[chr] and ord(score[pos])-33 >= 30:
-					if read[pos] in snp[chr][start+pos][0].split(';'): # A;T
-						votes[line.qname][0] += 1
-						match += 1
-					elif read[pos] in snp[chr][start+pos][1].split(';'): # C;G
-						votes[line.qname][1] += 1
-						match += 1
-					else:
-						unmatch += 1
-
-	outf1 = pysam.Samfile(strain1,'wb',template=infile)
-	outf2 = pysam.Samfile(strain2,'wb',template=infile)
-	outf3 = pysam.Samfile(mix,'wb',template=infile)
-	maternal, paternal, mixed = 0, 0, 0
-	for line in pysam.Samfile(bamF,'rb'):
-		if line.qname in votes:
-			if sum(votes[line.qname]) > 0:
-				if votes[line.qname][0]*1.0/sum(votes[line.qname]) >= 2.0/3:
-					maternal += 1
-					outf1.write(line)
-				elif votes[line.qname][0]*1.0/sum(votes[line.qname]) <= 1.0/3:
-					paternal += 1
-					outf2.write(line)
-				else:
-					mixed += 1
-					outf3.write(line)
-	outf1.close()
-	outf2.close()
-	outf3.close()
+	header = infile.header.to_dict()
+	header.setdefault('HD', {'VN':'1.6'})['SO'] = 'unsorted'
+	writer = SplitWriter([f"{prefix}.{k}.bam" for k in range(nout)], header, _worker_caller, tag)
+	## reads starting before the shard belong to the previous shard of the chromosome, * holds the unplaced unmapped reads
+	if chrom == '*':
+		lines = infile.fetch('*')
+	else:
+		lines = (line for line in infile.fetch(chrom, start, end) if line.reference_start >= start)
+	pending = split_pending(lines, _worker_caller, writer, coordinate=True, hold_orphans=True)
+	with pysam.Samfile(f"{prefix}.pending.bam",'wb',header=header) as outf:
+		for template in pending.values():
+			for i, line in enumerate(template.lines):
+				line.set_tag(SHARD_VOTES_TAG, template.votes if i == 0 else [0, 0])
+				outf.write(line)
+	writer.close()
 	infile.close()
+	return prefix, _worker_caller.stats
 
-	print(match,unmatch)
-	print(maternal, paternal, mixed)
 
+# shard votes tagged on a pending record, the tag is dropped before the record is written
+def pop_shard_votes(line):
+	v1, v2 = line.get_tag(SHARD_VOTES_TAG)
+	line.set_tag(SHARD_VOTES_TAG, None)
+	return v1, v2
 
-def split_bam_file_methyl(bamF,snpF,strain1,strain2):
-	snp = {}
-	for line in open(snpF,'r'):
-		line = line.strip().split('\t')
-		if line[0] not in snp:
-				snp[line[0]] = {}
-		snp[line[0]][int(line[1])] = [line[3],line[4]]
 
-	votes = {}
-	match, unmatch = 0,0
+# split an indexed bam in shards of chromosomes (or shard_size bp pieces of them) over processes,
+# then name sort the pending records of all shards and decide the templates spanning shards one name group at a time
+# by their summed shard votes, and concatenate the shards to the outputs
+def split_reads_parallel(bamF, caller, outnames, processes, shard_size=0, tag=None):
 	infile = pysam.Samfile(bamF,'rb')
-	for line in infile:
-		if line.qname not in votes:
-				votes[line.qname] = [0,0]
-		# print(line.rname)
-		chr = line.reference_name
-		start = line.pos + 1
-		if line.cigar:
-			read = ''
-			score = ''
-			index = 0
-			for cg in line.cigar:
-				if cg[0] == 0:
-					read += line.seq[index:(index+cg[1])]
-					score += line.qual[index:(index+cg[1])]
-					index += cg[1]
-				elif cg[0] == 2:
-					read += 'N'*cg[1]
-					score += '!'*cg[1]
-					index += cg[1]
-				else:
-					index += cg[1]
-			for pos in range(0,len(read)):
-				if chr in snp and start+pos in snp[chr] and ord(score[pos])-33 >= 30:
-					if read[pos] in snp[chr][start+pos][0].split(';'):
-						votes[line.qname][0] += 1
-						match += 1
-					elif read[pos] in snp[chr][start+pos][1].split(';'):
-						votes[line.qname][1] += 1
-						match += 1
-					else:
-						unmatch += 1
-
-	outf1 = pysam.Samfile(bamF[:-4]+'_'+strain1+'.bam','wb',template=infile)
-	outf2 = pysam.Samfile(bamF[:-4]+'_'+strain2+'.bam','wb',template=infile)
-	outf3 = pysam.Samfile(bamF[:-4]+'_mixed.bam','wb',template=infile)
-	maternal, paternal, mixed = 0, 0, 0
-	for line in pysam.Samfile(bamF,'rb'):
-		if line.qname in votes:
-			if sum(votes[line.qname]) > 0:
-				if votes[line.qname][0]*1.0/sum(votes[line.qname]) >= 2.0/3:
-					maternal += 1
-					outf1.write(line)
-				elif votes[line.qname][0]*1.0/sum(votes[line.qname]) <= 1.0/3:
-					paternal += 1
-					outf2.write(line)
-				else:
-					mixed += 1
-					outf3.write(line)
-	outf1.close()
-	outf2.close()
-	outf3.close()
+	if not infile.has_index():
+		raise ValueError(f"{bamF} is not indexed, run samtools index first or drop --processes")
+	step = shard_size if shard_size > 0 else max(infile.lengths, default=1)
+	regions = [(chrom, start, min(start+step, length)) for chrom, length in zip(infile.references, infile.lengths) for start in range(0, length, step)] + [('*', 0, 0)]
 	infile.close()
+	tmpdir = tempfile.mkdtemp(prefix="snpSelection.", dir=os.path.dirname(os.path.abspath(outnames[0])))
+	try:
+		snp_npz = os.path.join(tmpdir, "snp.npz")
+		caller.snp.save(snp_npz)
+		units = [(bamF, chrom, start, end, os.path.join(tmpdir, f"shard{i}"), len(outnames), tag) for i, (chrom, start, end) in enumerate(regions)]
+		print(len(units), "shards of", bamF, "on", processes, "processes")
+		prefixes = []
+		with multiprocessing.Pool(processes, initializer=init_shard_worker, initargs=(snp_npz, caller.strain1_frac, caller.strain2_frac, caller.min_qual)) as pool:
+			for prefix, stats in pool.imap(split_shard, units):
+				prefixes.append(prefix)
+				caller.merge(stats)
+		pending = os.path.join(tmpdir, "pending")
+		pysam.cat("-o", f"{pending}.bam", *[f"{prefix}.pending.bam" for prefix in prefixes])
+		pysam.sort("-n", "-@", str(processes), "-T", f"{pending}.sort", "-o", f"{pending}.name.bam", f"{pending}.bam")
+		reconciled = os.path.join(tmpdir, "reconciled")
+		with pysam.Samfile(f"{pending}.bam",'rb') as infile:
+			header = infile.header.to_dict()
+		writer = SplitWriter([f"{reconciled}.{k}.bam" for k in range(len(outnames))], header, caller, tag)
+		with pysam.Samfile(f"{pending}.name.bam",'rb') as infile:
+			n = split_name_groups(infile, writer, pop_shard_votes)
+		writer.close()
+		print(n, "templates span shards, decided by their summed votes")
+		for k, name in enumerate(outnames):
+			pysam.cat("-o", name, *[f"{prefix}.{k}.bam" for prefix in prefixes], f"{reconciled}.{k}.bam")
+	finally:
+		shutil.rmtree(tmpdir)
 
-	print(match,unmatch)
-	print(maternal, paternal, mixed)
-
-
-def allelic_MPBN(infile, outfile, c1, c2, valid_count = 10):
-	df = pd.read_table(infile, sep ='\t', header = None, skiprows = 0)
-	# df.columns = ['#Chr','Start','End','RefSeq','GeneSymbol','Strand','txStart','txEnd','Score','exonCount','exonStarts','exonEnds','BP.E65_EPI.Mat','BP.E65_EPI.Pat','PB.E65_EPI.Mat','PB.E65_EPI.Pat','BP.E65_VE.Mat','BP.E65_VE.Pat','PB.E65_VE.Mat','PB.E65_VE.Pat','BP.E65_EXE.Mat','BP.E65_EXE.Pat','PB.E65_EXE.Mat','PB.E65_EXE.Pat','BP.E95_Placenta.Mat','BP.E95_Placenta.Pat','PB.E95_Placenta.Mat','PB.E95_Placenta.Pat']
-	outf = open(outfile, 'w')
-	print('RefSeq\tGeneSymbol\tMat\tPat\tp-value\tAS\tclass', file=outf)
-
-	with open(infile, 'r') as f:
-		# next(f)
-		# next(f)
-		for line in f:
-			line = line.strip().split('\t')
-			if int(line[c1]) + int(line[c2]) < valid_count:
-				# continue
-				print('\t'.join([line[3],line[4],line[c1],line[c2],'-','-','N']), file=outf)
-			else:
-				# pBase = float(df.iloc[:,c1].sum())/(float(df.iloc[:,c1].sum()) + float(df.iloc[:,c2].sum()))
-				# pvalue = binom_test(int(line[c1]),int(line[c1]) + int(line[c2]), pBase)+1E-300
-				pvalue = binom_test(int(line[c1]),int(line[c1]) + int(line[c2]), 0.5)+1E-300
-				if pvalue <= 0.001:
-					if int(line[c1]) > int(line[c2]):
-						print('\t'.join([line[3],line[4],line[c1],line[c2],str(pvalue),str(-math.log10(pvalue)),'M']), file=outf)
-					else:
-						print('\t'.join([line[3],line[4],line[c1],line[c2],str(pvalue),str(math.log10(pvalue)),'P']), file=outf)
-				else:
-					if int(line[c1]) > int(line[c2]):
-						print('\t'.join([line[3],line[4],line[c1],line[c2],str(pvalue),str(-math.log10(pvalue)),'B']), file=outf)
-					else:
-						print('\t'.join([line[3],line[4],line[c1],line[c2],str(pvalue),str(math.log10(pvalue)),'B']), file=outf)
-		outf.close()
+
+# outnames: strain1, strain2 and mixed bams, or a single bam when reads are tagged
+def run_split(bamF, snp, outnames, single_pass=False, processes=1, shard_size=0, strain1_frac=2.0/3, strain2_frac=1.0/3, min_qual=30, tag=None, report=None):
+	caller = AlleleCaller(snp, strain1_frac, strain2_frac, min_qual)
+	if processes > 1:
+		split_reads_parallel(bamF, caller, outnames, processes, shard_size, tag)
+	else:
+		split_reads(bamF, caller, outnames, single_pass, tag)
+	print(caller.total('strain1_bases') + caller.total('strain2_bases'), caller.total('unmatched_bases'))
+	print(caller.total('G1'), caller.total('G2'), caller.total('CF'))
+	if report:
+		caller.report(report)
+	return caller
+
+
+def split_bam_file(bamF,snpF,strain1,strain2=None,mix=None,tag=None,**kwargs):
+	# with tag, strain1 is the single tagged output bam
+	snp = SnpIndex.open(snpF, add_chr=True)
+	outnames = [strain1] if tag else [strain1, strain2, mix]
+	return run_split(bamF, snp, outnames, tag=tag, **kwargs)
+
+
+def split_bam_file_methyl(bamF,snpF,strain1,strain2,prefix=None,tag=None,**kwargs):
+	# outputs are <prefix>_<strain1>.bam, <prefix>_<strain2>.bam and <prefix>_mixed.bam, or <prefix>_tagged.bam with tag
+	snp = SnpIndex.open(snpF, add_chr=False)
+	prefix = prefix or bamF[:-4]
+	outnames = [prefix+'_tagged.bam'] if tag else [prefix+'_'+strain1+'.bam', prefix+'_'+strain2+'.bam', prefix+'_mixed.bam']
+	return run_split(bamF, snp, outnames, tag=tag, **kwargs)
+
+
+# two-sided binomial test of k successes in n trials with p=0.5, as binom_test, for arrays
+def binom_test_half(k, n):
+	return np.minimum(1.0, 2*np.minimum(binom.cdf(k, n, 0.5), binom.sf(k-1, n, 0.5)))
+
+
+# Benjamini-Hochberg adjusted p-values
+def bh_fdr(pvalues):
+	pvalues = np.asarray(pvalues, dtype=float)
+	order = np.argsort(pvalues)
+	ranked = pvalues[order] * len(pvalues) / np.arange(1, len(pvalues)+1)
+	fdr = np.empty_like(pvalues)
+	fdr[order] = np.minimum(1.0, np.minimum.accumulate(ranked[::-1])[::-1])
+	return fdr
+
+
+# test allelic imbalance of columns c1 (maternal) and c2 (paternal) for all genes at once, pairs adds more column pairs
+# genes with fewer than valid_count reads are not tested (class N), tested genes with p <= 0.001 are M or P, others B
+# AS is -log10(p) when Mat > Pat else log10(p); FDR is Benjamini-Hochberg over the tested genes of each pair
+def allelic_MPBN(infile, outfile, c1, c2, valid_count = 10, pairs=()):
+	pairs = [(c1, c2)] + [tuple(pair) for pair in pairs]
+	df = pd.read_csv(infile, sep='\t', header=None, dtype={3:str, 4:str})
+	out = pd.DataFrame({'RefSeq':df[3], 'GeneSymbol':df[4]})
+	for a, b in pairs:
+		mat, pat = df[a].to_numpy(dtype=np.int64), df[b].to_numpy(dtype=np.int64)
+		tested = mat + pat >= valid_count
+		pvalue = np.full(len(df), np.nan)
+		pvalue[tested] = binom_test_half(mat[tested], mat[tested] + pat[tested]) + 1E-300
+		fdr = np.full(len(df), np.nan)
+		fdr[tested] = bh_fdr(pvalue[tested])
+		AS = np.where(mat > pat, -np.log10(pvalue), np.log10(pvalue))
+		cls = np.where(~tested, 'N', np.where(pvalue <= 0.001, np.where(mat > pat, 'M', 'P'), 'B'))
+		name = '' if len(pairs) == 1 else f"{a}:{b}."
+		out[name+'Mat'] = mat
+		out[name+'Pat'] = pat
+		out[name+'p-value'] = pvalue
+		out[name+'AS'] = AS
+		out[name+'class'] = cls
+		out[name+'FDR'] = fdr
+	out.to_csv(outfile, sep='\t', index=False, na_rep='-')
 
 def mkdirs(path):
 	path=os.path.abspath(path)
@@ -189,18 +508,73 @@ def mkdirs(path):
 	return True
 
 
+def build_snp_index(snpF, out, add_chr=True):
+	snp = SnpIndex.from_text(snpF, add_chr=add_chr)
+	snp.save(out)
+	print(len(snp), "SNPs on", len(snp.positions), "chromosomes indexed to", out)
+
+
+def generate_opt():
+	parser = argparse.ArgumentParser(description="split bam file based on snp, and test allelic imbalance of counts")
+	sub = parser.add_subparsers(dest="selection", required=True)
+	## options shared by split and splitMethyl
+	common = argparse.ArgumentParser(add_help=False)
+	common.add_argument("--single-pass", action="store_true", dest="single_pass", help="read the bam once, keeping only reads whose mates are pending; exact for name sorted/grouped input only, in other orders secondary and late supplementary votes no longer count toward their template, so strain calls can differ from the default mode")
+	common.add_argument("-p", "--processes", type=int, default=1, help="split an indexed bam in chromosome shards over processes, mates across shards are reconciled at the end; as with --single-pass, secondary and late supplementary votes may not count toward their template, so strain calls can differ from the default mode")
+	common.add_argument("--shard-size", type=int, default=0, dest="shard_size", help="with --processes, also cut chromosomes into shards of this many bp; 0 keeps whole chromosomes")
+	common.add_argument("--strain1-frac", type=float, default=2.0/3, dest="strain1_frac", help="read names with at least this fraction of strain1 votes go to strain1, default 2/3")
+	common.add_argument("--strain2-frac", type=float, default=1.0/3, dest="strain2_frac", help="read names with at most this fraction of strain1 votes go to strain2, default 1/3")
+	common.add_argument("--min-qual", type=int, default=30, dest="min_qual", help="min base quality of SNP bases to vote")
+	common.add_argument("--tag", default=None, help="write one bam with every read tagged by this tag instead, e.g. ZG (X?, Y?, Z? and lowercase tags are left to users; a tag the reads already carry is overwritten): G1/G2 strain, CF conflict, UA unassigned")
+	common.add_argument("--report", default=None, help="write per chromosome SNP hits, conflicts and assignment rates to <report>.tsv and <report>.json")
+	p = sub.add_parser("split", parents=[common], help="split reads to strain1/strain2/mixed bams by their snp votes")
+	p.add_argument("bamF")
+	p.add_argument("snpF", help="snp file (chr, pos, id, strain1 alleles, strain2 alleles) or its .npz index")
+	p.add_argument("strain1", help="output bam of strain1, or the single output bam with --tag")
+	p.add_argument("strain2", nargs="?", help="output bam of strain2")
+	p.add_argument("mix", nargs="?", help="output bam of mixed reads")
+	p = sub.add_parser("splitMethyl", parents=[common], help="split reads like split, output <bam>_<strain>.bam, snp chromosomes are used as is")
+	p.add_argument("bamF")
+	p.add_argument("snpF", help="snp file or its .npz index")
+	p.add_argument("strain1", help="name of strain1")
+	p.add_argument("strain2", help="name of strain2")
+	p.add_argument("--prefix", default=None, help="prefix of the outputs, default is the bam path without .bam")
+	p = sub.add_parser("allele_negLogPValue", help="binomial test of allelic counts")
+	p.add_argument("infile")
+	p.add_argument("outfile")
+	p.add_argument("c1", type=int, help="0-based column of maternal counts")
+	p.add_argument("c2", type=int, help="0-based column of paternal counts")
+	p.add_argument("valid_count", type=int, nargs="?", default=10, help="genes with fewer counts are not tested")
+	p.add_argument("--pair", type=int, nargs=2, action="append", default=[], dest="pairs", metavar=("C1", "C2"), help="more maternal/paternal column pairs to test in the same run, output columns are prefixed by c1:c2.")
+	p = sub.add_parser("index", help="build a .npz snp index once, to be used as snpF of split/splitMethyl")
+	p.add_argument("snpF", help="snp file (chr, pos, id, strain1 alleles, strain2 alleles)")
+	p.add_argument("out", help="output .npz index")
+	p.add_argument("--no-chr", action="store_false", dest="add_chr", help="keep chromosome names as is, as splitMethyl does; by default chr is prefixed as split does")
+	return parser
+
+
 def main():
-	selection = sys.argv[1]
-	for i in sys.argv[3:7]:
-		path=pathlib.Path(i)
-		path.parent.mkdir(parents=True,exist_ok=True)
-		print("### ",path.parent, "\t maked")
-	if selection == "split":
-		split_bam_file(sys.argv[2],sys.argv[3],sys.argv[4],sys.argv[5],sys.argv[6]) # bamF, snpF, strain1, strain2, mixname
-	if selection == "splitMethyl":
-		split_bam_file_methyl(sys.argv[2],sys.argv[3],sys.argv[4],sys.argv[5]) # bamF, snpF, strain1, strain2
-	if selection == "allele_negLogPValue":
-		allelic_MPBN(sys.argv[2],sys.argv[3], int(sys.argv[4]), int(sys.argv[5])) #infile, outfile, c1, c2, valid_count
-
-
-main()
+	parser = generate_opt()
+	args = parser.parse_args()
+	if args.selection == "split" and not args.tag and (args.strain2 is None or args.mix is None):
+		parser.error("split needs strain1 strain2 mix outputs, or --tag with one output")
+	outputs = ("prefix", "report") if args.selection == "splitMethyl" else ("strain1", "strain2", "mix", "outfile", "out", "report")
+	for name in outputs:
+		if getattr(args, name, None):
+			path=pathlib.Path(getattr(args, name))
+			path.parent.mkdir(parents=True,exist_ok=True)
+			print("### ",path.parent, "\t maked")
+	if args.selection == "split":
+		split_bam_file(args.bamF, args.snpF, args.strain1, args.strain2, args.mix, tag=args.tag, single_pass=args.single_pass, processes=args.processes, shard_size=args.shard_size,
+			strain1_frac=args.strain1_frac, strain2_frac=args.strain2_frac, min_qual=args.min_qual, report=args.report)
+	if args.selection == "splitMethyl":
+		split_bam_file_methyl(args.bamF, args.snpF, args.strain1, args.strain2, prefix=args.prefix, tag=args.tag, single_pass=args.single_pass, processes=args.processes, shard_size=args.shard_size,
+			strain1_frac=args.strain1_frac, strain2_frac=args.strain2_frac, min_qual=args.min_qual, report=args.report)
+	if args.selection == "allele_negLogPValue":
+		allelic_MPBN(args.infile, args.outfile, args.c1, args.c2, args.valid_count, args.pairs)
+	if args.selection == "index":
+		build_snp_index(args.snpF, args.out, args.add_chr)
+
+
+if __name__ == "__main__":
+	main()